@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 #########################################################################
 # Use: Check credentials against multiple devices and log connections   #
-# Version: 1.5                                                          #
+# Version: 1.6                                                          #
 #                                                                       #
 # Input: devices.txt file with one device hostname or IP address per    #
-#        line. This can include CIDR networks                           #
+#        line. This can include CIDR networks. Optional key=value tags  #
+#        may follow the device on the same line (site=branch1)          #
 # Output: Info is output to screen and logged (username_checked.csv).   #
 #         Offers to export available devices found to file.             #
 #                                                                       #
@@ -13,7 +14,8 @@
 #                 Password:                                             #
 #                 Hostname# or Hostname>                                #
 #              Script keys off "Username:", "Password:", and "#" or ">" #
-#              to validate successful connections                       #
+#              to validate successful connections. Other vendors can be #
+#              described in profiles.json                               #
 #########################################################################
 
 # Used to colorize output
@@ -21,12 +23,22 @@ from colorama import init
 from colorama import Fore
 # Used to get user credentials and mask user input for passwords
 import getpass
-# Used for SSH connections
-from netmiko import ConnectHandler
-# Used for telnet connections
-import telnetlib
+# Used to load the SSH backend when first needed
+import importlib
+# Used to run many telnet sessions from one thread
+import selectors
+# Used to run the system OpenSSH client
+import subprocess
+import shlex
+import tempfile
+# Used to watch devices.txt for changes
+import select
+import ctypes
+import ctypes.util
 # Used for file naming purposes
 from time import strftime
+# Used to measure authentication latency and throttle connections
+import time
 # Used to report scan time
 from datetime import datetime
 # Used to verify device availability
@@ -37,39 +49,342 @@ from sys import platform
 from netaddr import IPNetwork
 # Used to support multiple connections
 import threading
+# Used to queue devices per site for scheduling
+from collections import deque, OrderedDict
+# Used to hold results compactly for the summary
+from array import array
+# Used for the daemon job queue and HTTP API
+import heapq
+import queue
+import socketserver
 # Used to suppress connection reset errors
 import sys
+import logging
+# Used to load and match device prompt profiles and write JSON Lines
+import json
+import re
+import gzip
+import shutil
+# Used to fingerprint SSH host keys
+import hashlib
+import base64
+# Used to resolve device addresses and classify connection errors
+import socket
+import errno
 
 # colorama initialization, required for windows
 init(autoreset=True)
 
 
 # Display script name and version
-user_message = Fore.YELLOW + "\n\nCredential Check - v1.5\n\n" + Fore.WHITE
+user_message = Fore.YELLOW + "\n\nCredential Check - v1.6\n\n" + Fore.WHITE
 print(user_message)
 
 
+# Protocol backends, imported the first time a device needs them
+# netmiko (SSH) pulls in paramiko, cryptography and textfsm, so runs that
+# never reach SSH don't pay for importing it. Telnet uses the built-in
+# TelnetLoop below, started when the first device needs it
+backend_modules = {
+    'ssh': 'netmiko',
+    'jump': 'paramiko',
+}
+# Connection errors logged by paramiko and netmiko (resets, banner errors)
+# are kept off the screen. Set to a file name to keep them for debugging
+ssh_log_file = ''
+backends = {}
+backend_lock = threading.Lock()
+telnet_loop = None
+jump_pool = None
+openssh_dir = None
+# Host key fingerprints seen with the current credential set
+run_identities = {}
+identity_lock = threading.Lock()
+# Daemon job currently being run, if any
+current_job = None
+# Writes results to one file per partition when partition_by is set
+partitions = None
+# When the current scan must finish, None without a time budget. Canary
+# checks run before a scan sets it
+budget_deadline = None
+# Credential sets (indexes into usernames) rejected by every canary device
+canary_failed = set()
+
+
+# Device inventory, one device or CIDR network per line
+inventory_file = 'devices.txt'
+
+
 # Limits the number of simultaneous threads and screen writes
 maxthreads = 50
-sema = threading.BoundedSemaphore(value=maxthreads)
 screenlock = threading.Semaphore(value=1)
+# Limits Telnet logins in progress on the Telnet loop. These don't hold a
+# thread, so many more can run than maxthreads
+telnet_maxsessions = 2000
+
+# Seconds to wait for a TCP connection to the SSH or Telnet port
+connect_timeout = 2
+# Seconds to wait for each telnet prompt
+telnet_timeout = 2
+
+# Learn timeouts for each device (or its subnet until it has been seen)
+# from measured connect times, SSH version string times and Telnet login
+# latency (each learned separately), kept between runs, instead of using
+# connect_timeout and telnet_timeout for everything
+# Each timeout is the smoothed time plus four times its variation, as TCP
+# does for retransmits, kept between adaptive_min_timeout and
+# adaptive_max_timeout. A timeout doubles the learned time for next run
+adaptive_timeouts = False
+adaptive_prefix_len = 24
+adaptive_min_timeout = 0.5
+adaptive_max_timeout = 10
+timeout_lock = threading.Lock()
+
+# SSH backend, 'netmiko' or 'openssh'
+# 'openssh' runs the system ssh client (native crypto) instead of paramiko,
+# supplying the password through SSH_ASKPASS. Needs OpenSSH 8.4 or later on
+# Linux/macOS. Login success or failure is taken from ssh's verbose output,
+# so devices that refuse to run a command still count as logged in. With a
+# jump host, one ControlMaster connection to it is shared by every check
+# (kept openssh_persist seconds after the last one). It logs in with
+# jump_password, or with jump_key_file or the SSH agent if that's empty, and
+# the jump host's key must be in known_hosts. Enable secrets
+# aren't checked with this backend. Extra ssh options (e.g. older key
+# exchange algorithms some devices need) go in openssh_options
+ssh_backend = 'netmiko'
+openssh_command = 'ssh'
+openssh_options = []
+openssh_timeout = 30
+openssh_persist = 5
+
+# Reach devices for SSH checks through a jump host (bastion)
+# A few authenticated connections to the jump host are shared by every
+# check, each device getting its own channel over one of them, so the jump
+# host sees jump_connections logins instead of one per device. Uses
+# jump_key_file or the SSH agent, or prompts for a password if neither.
+# The jump host's key must be in known_hosts. Telnet isn't tried in this mode
+jump_host = ''
+jump_port = 22
+jump_username = ''
+jump_key_file = ''
+jump_connections = 4
+# Keep at or below the jump host's MaxSessions (OpenSSH default 10)
+jump_channels = 10
+jump_password = ''
+
+# Limits the number of devices being checked at once at any one site
+# Devices are grouped by their site tag in devices.txt (site=branch1),
+# otherwise by subnet using site_prefix_len. Only applies once site tags or
+# site_limits are set, until then only maxthreads limits a scan
+site_maxthreads = 10
+site_prefix_len = 24
+# Per-site overrides for site_maxthreads, e.g. {'branch1': 4}
+site_limits = {}
+
+# AAA (TACACS+/RADIUS) backpressure detection
+# Authentication latency and unanswered logins are tracked over the last
+# aaa_window attempts. Once the average latency (seconds) or the rate of
+# unanswered logins crosses these limits, new connections are started
+# aaa_throttle_delay seconds apart and failures are marked for retry
+aaa_window = 50
+aaa_min_samples = 10
+aaa_latency_limit = 1.5
+aaa_timeout_limit = 0.3
+aaa_throttle_delay = 1.0
+
+# Verify the enable secret in the same session once logged in
+# Prompts for an enable secret with each credential set and adds an
+# enable column to the log
+check_enable = False
+
+# Vendor prompt profiles
+# Loaded from profile_file if found, otherwise the built-in profiles below are
+# used. Devices can name their profile in devices.txt (profile=arris).
+# Otherwise the profile is detected from the SSH version string or Telnet
+# banner (ssh_banner, telnet_banner patterns) and saved for later runs;
+# until then default_profile is used for SSH and every profile's prompts
+# are matched for Telnet
+profile_file = 'profiles.json'
+default_profile = 'cisco_ios'
+builtin_profiles = {
+    'cisco_ios': {
+        'device_type': 'cisco_ios_ssh',
+        'ssh_banner': "^SSH-[0-9.]+-Cisco",
+        'paging': "terminal length 0",
+        'login': [["Username: ", "username"], ["Password: ", "password"]],
+        'success': "[#>]",
+    },
+    'arris': {
+        'device_type': None,
+        'login': [["Username: ", "username"], ["Password: ", "password"], ["password>", "password"]],
+        'success': "Console>",
+        'enable': False,
+    },
+}
+
+# Time budget for the whole scan in minutes, 0 for no limit
+# The scan estimates the time per device from the first budget_samples
+# checks, raises the thread count (up to budget_maxthreads) and shortens
+# timeouts (down to budget_min_timeout seconds) to finish in time. High
+# priority devices (priority=high) and devices not yet verified go first.
+# Devices not reached in time are logged as not checked
+time_budget = 0
+budget_samples = 20
+budget_maxthreads = 200
+budget_min_timeout = 1
+
+# Information kept between runs (last verified time, SSH host key
+# fingerprint, detected profile and learned timeouts of each device)
+state_file = 'credential_check_state.json'
+
+# Check each physical device once per credential set
+# Devices listed under several addresses or names are recognised by the SSH
+# host key fingerprint saved from earlier runs. Only the first is checked,
+# the rest are logged as duplicates of it
+dedupe_by_host_key = False
+
+# Run mode, 'scan' for a normal interactive scan, 'watch' to check devices
+# as they are added to devices.txt, 'daemon' to run as a local audit
+# service taking jobs over HTTP or 'replay' to serve recorded Telnet
+# transcripts (see transcript_devices)
+# Watch mode waits for devices.txt to change (inotify on Linux, otherwise
+# checking every watch_interval seconds), checks only the devices added and
+# keeps watch_results_file up to date, dropping devices that were removed
+# The daemon keeps the inventory, profiles, saved state, SSH backend and
+# Telnet loop loaded between jobs. Jobs run one at a time, highest priority
+# first. It listens on daemon_address:daemon_port, or on the Unix socket
+# daemon_socket if set. Credentials are sent to it, keep it on localhost
+run_mode = 'scan'
+daemon_address = '127.0.0.1'
+daemon_port = 8650
+daemon_socket = ''
+watch_interval = 2
+watch_results_file = 'watch_results.csv'
+
+# Records the Telnet sessions of these devices (or devices tagged
+# transcript=yes) to transcript_dir, one JSON file per session with every
+# byte sent and received and when. Usernames, passwords and enable secrets
+# are replaced with <username>, <password> and <enable>
+# Replay mode serves each transcript in transcript_dir on its own loopback
+# address (127.0.1.1, 127.0.1.2, ...) on replay_port and writes those
+# addresses (with a telnet= port tag) to replay_devices.txt, so prompt handling changes can be tested
+# against real device behaviour offline by scanning that file. replay_speed
+# scales the recorded delays (0 replays as fast as possible). Extra
+# loopback addresses work on Linux; elsewhere they need adding first
+transcript_devices = []
+transcript_dir = 'transcripts'
+replay_port = 23
+replay_speed = 1.0
+replay_timeout = 30
+
+# Samples every thread's stack while scanning to show where time goes
+# Writes profile_<date>.collapsed (input for flamegraph.pl or speedscope)
+# and adds the hottest functions to the summary
+profile_scan = False
+profile_interval = 0.005
+profile_top = 15
+
+# Split each credential set's log into one file per partition
+# partition_by lists the keys results are split by: 'site' (site tag, or
+# subnet/domain as used for scheduling), 'subnet' (partition_prefix_len) or
+# 'outcome'. ['site', 'outcome'] gives files such as
+# username_..._branch1_success.csv, plus username_..._index.csv mapping each
+# device to its file. partition_gzip compresses the files when the
+# credential set finishes
+partition_by = []
+partition_prefix_len = 24
+partition_gzip = False
+# Most partition files kept open at once. The least recently written is
+# closed when another is needed and reopened (appending) if written again
+partition_max_open = 64
+
+# Read-only commands run on every session that logs in, so inventory
+# doesn't need a second login to each device. Output of each command
+# (waiting up to inventory_timeout seconds) is saved to
+# inventory_dir/<device>.txt and added to JSON Lines records. Only commands
+# starting with show or display are run. Telnet sessions first turn off
+# paging with the profile's paging command
+inventory_commands = []
+inventory_timeout = 10
+inventory_dir = 'inventory'
+
+# Stop checking a credential set that devices keep rejecting
+# After breaker_consecutive rejections in a row, or when breaker_reject_rate
+# (0.9 = 90%) of the last breaker_window logins were rejected, devices not
+# yet started are logged as "Stopped - credentials rejected repeatedly" and
+# the next credential set begins. Unreachable devices and logins marked for
+# retry while AAA is overloaded don't count. 0 turns a rule off
+breaker_consecutive = 0
+breaker_window = 50
+breaker_reject_rate = 0
+
+# Canary devices each credential set is tried on before the full scan
+# Devices can also be tagged canary=yes in devices.txt. A credential set
+# rejected by every canary that answers is probably mistyped and would only
+# fail (and risk locking out the account) across the whole inventory.
+# canary_action 'ask' asks whether to scan with it anyway, 'skip' leaves it
+# out without asking (daemon jobs always skip)
+canary_devices = []
+canary_action = 'ask'
+
+# Streams every result as a JSON Lines record as soon as it completes
+# Set to a file name, or '-' for stdout (screen output then goes to stderr
+# so the stream can be piped into other tools)
+jsonl_output = ''
 
 
 def main():
+    # Run as a long-running audit service if configured
+    if run_mode == 'daemon':
+        daemon()
+        return
+    # Keep checking devices as they are added to devices.txt if configured
+    if run_mode == 'watch':
+        watch()
+        return
+    # Serve recorded Telnet sessions if configured
+    if run_mode == 'replay':
+        replay()
+        return
+
     # Collect credential sets and list of devices to scan
     initialize_script()
+    # Load information saved by previous runs
+    load_state()
+    # Catch mistyped credentials before they fail on every device
+    canary_check()
 
     # Record start time of scans
     global start_time
     start_time = datetime.now()
+    # Work out when the scan must finish if it has a time budget
+    global budget_deadline
+    budget_deadline = None
+    if time_budget > 0:
+        budget_deadline = time.time() + time_budget * 60
+    # Results of every check, used for the summary
+    global results
+    results = ResultTable()
+    # Start sampling profiler if requested
+    global profiler
+    profiler = None
+    if profile_scan:
+        profiler = SamplingProfiler(profile_interval)
+        profiler.start()
+    # Open JSON Lines stream if requested
+    open_jsonl()
+
     # Run connection tests using provided credentials
-    global usernames
-    for cred_set in usernames:
-        global username, password, enablepw
-        username = cred_set[0]
-        password = cred_set[1]
-        enablepw = cred_set[2]
-        connection_test()
+    run_credential_sets()
+
+    if jsonl_file is not None and jsonl_output != '-':
+        jsonl_file.close()
+
+    if profiler is not None:
+        profiler.stop()
+
+    # Save information for the next run
+    save_state()
 
     # Provide summary reports before exit
     summary()
@@ -77,17 +392,91 @@ def main():
 
 
 
+def open_jsonl():
+    # Open JSON Lines stream if requested
+    global jsonl_file
+    jsonl_file = None
+    if jsonl_output == '-':
+        # Screen output moves to stderr so stdout only carries the stream
+        jsonl_file = sys.stdout
+        sys.stdout = sys.stderr
+    elif jsonl_output != '':
+        jsonl_file = open(jsonl_output, 'a')
+
+
+def run_credential_sets():
+    # Run connection tests for every credential set in usernames
+    for index in range(len(usernames)):
+        if index in canary_failed:
+            continue
+        use_credentials(index)
+        connection_test()
+
+
+def use_credentials(index):
+    # Make usernames[index] the credential set being checked
+    global cred_index, username, password, enablepw, cred_label
+    cred_index = index
+    username = usernames[index][0]
+    password = usernames[index][1]
+    enablepw = usernames[index][2]
+    # Identifies the credential set in results without the password
+    cred_label = username + "#" + str(cred_index + 1)
+
+
+def canary_check():
+    # Try each credential set on the canary devices before the full scan
+    # A set no canary accepts and at least one rejects is most likely
+    # mistyped; it is left out of the scan (or kept if the user says so).
+    # Unreachable canaries say nothing about the credentials
+    global canary_failed, aaa_monitor
+    canary_failed = set()
+    canaries = list(canary_devices) + [device for device in device_info
+        if device_info[device].get('canary', '').lower() in ('yes', 'true')
+        and device not in canary_devices]
+    if not canaries:
+        return
+    print(Fore.MAGENTA + "\n\nTrying credentials on " + str(len(canaries)) + " canary devices..." + Fore.WHITE)
+    for index in range(len(usernames)):
+        use_credentials(index)
+        aaa_monitor = AaaMonitor()
+        checks = []
+        threads = []
+        finished = []
+        for device in canaries:
+            check = new_check(device, 0)
+            checks.append(check)
+            finished.append(threading.Event())
+            thread = threading.Thread(target=check_device, args=(check, finished[-1].set), name="canary-" + str(len(checks)))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        for event in finished:
+            event.wait()
+
+        outcomes = [outcome_class(check) for check in checks]
+        accepted = outcomes.count("success")
+        rejected = outcomes.count("auth_rejected")
+        if accepted > 0 or rejected == 0:
+            print(Fore.MAGENTA + "   " + username + ": accepted by " + str(accepted) + ", rejected by " +
+                str(rejected) + " of " + str(len(canaries)) + " canary devices." + Fore.WHITE
+            )
+            continue
+        print(Fore.YELLOW + "   " + username + ": rejected by every canary device that answered (" +
+            str(rejected) + " of " + str(len(canaries)) + ")." + Fore.WHITE
+        )
+        # Jobs and unattended runs can't be asked, the set is skipped
+        if canary_action == 'ask' and current_job is None:
+            user_message = Fore.CYAN + "   Scan all devices with these credentials anyway? (y/n) " + Fore.WHITE
+            if input(user_message).lower() == 'y':
+                continue
+        canary_failed.add(index)
+
+
 def initialize_script():
     # Prompt for user credentials
-    global usernames
-    username, password, enablepw = user_credentials()
-    usernames = [[username, password, enablepw]]
-
-    # Offer to check additional credentials
-    user_message = Fore.CYAN + "\nWould you like to check additional credentials? (y/n) " + Fore.WHITE
-    additional_check = input(user_message)
-    if additional_check.lower() == 'y':
-        usernames = additional_creds()
+    collect_credentials()
 
     # Offer to check availability of devices before scanning
     user_message = Fore.CYAN + "\nWould you like to check availability before scanning? (y/n) " + Fore.WHITE
@@ -106,11 +495,11 @@ def initialize_script():
             else:
                 device_file = device_file.strip() + '.txt'
 
+    # Load vendor prompt profiles
+    load_profiles()
+
     # Initialize variables needed for devices
     global device_list
-    global device
-    # Create device list to populate from devices.txt
-    temp_list = []
     device_list = []
 
     # open the devices text file in read-only mode
@@ -118,29 +507,7 @@ def initialize_script():
         print(Fore.MAGENTA + "\n\nImporting devices and checking availability..." + Fore.WHITE)
     else:
         print(Fore.MAGENTA + "\n\nImporting devices..." + Fore.WHITE)
-    with open('devices.txt', 'r') as fn:
-
-        # iterate through the lines in the text file
-        for line in fn.read().splitlines():
-
-            # skip empty lines
-            if line is '':
-                continue
-
-            else:
-                if avail_check == 'y':
-                    print(Fore.MAGENTA + "    Adding " + str(line) + Fore.WHITE)
-                # Check if CIDR network was entered
-                if "/" in line:
-                    # Convert CIDR to individual hosts
-                    for ip in IPNetwork(line):
-                        # Converted host from CIDR is device
-                        device = ip
-                        temp_list.append(str(device))
-                else:
-                    # entire line is device
-                    device = line
-                    temp_list.append(str(device))
+    temp_list = load_devices(avail_check == 'y')
 
     # Check availability of devices if requested
     if avail_check == 'y':
@@ -153,21 +520,8 @@ def initialize_script():
         hide_cursor()
         threading.Timer(10, wait_message).start()
 
-        # Starts threads to check availability
-        threads = []
-        for device in temp_list:
-            my_thread = threading.Thread(target=online_device_add, args=(device,))
-            # Pull from pool of available threads
-            sema.acquire()
-            # Start thread
-            my_thread.start()
-            threads.append(my_thread)
-
-        # Joining will ensure all threads complete before continuing
-        main_thread = threading.currentThread()
-        for t in threads:
-            if t != main_thread:
-                t.join()
+        # Starts threads to check availability, spread across sites
+        SiteScheduler(temp_list, limit_sites=False).run(online_device_add)
 
         # Record total devices and availability scan time for output later
         global avail_scan_time
@@ -189,12 +543,71 @@ def initialize_script():
     avail_complete = "y"
 
 
+def load_devices(verbose=False):
+    # Create device list to populate from devices.txt
+    global device_info
+    temp_list = []
+    # Tags for each device (site=branch1) keyed by device
+    device_info = {}
+    with open(inventory_file, 'r') as fn:
+
+        # iterate through the lines in the text file
+        for line in fn.read().splitlines():
+
+            # skip empty lines
+            if line.strip() == '':
+                continue
+
+            else:
+                if verbose:
+                    print(Fore.MAGENTA + "    Adding " + str(line) + Fore.WHITE)
+                # First field is the device, any remaining fields are tags
+                fields = line.split()
+                entry = fields[0]
+                tags = dict(field.split("=", 1) for field in fields[1:] if "=" in field)
+                # Check if CIDR network was entered
+                if "/" in entry:
+                    # Convert CIDR to individual hosts
+                    for ip in IPNetwork(entry):
+                        # Converted host from CIDR is device
+                        device = ip
+                        temp_list.append(str(device))
+                        device_info[str(device)] = tags
+                else:
+                    # first field is device
+                    device = entry
+                    temp_list.append(str(device))
+                    device_info[str(device)] = tags
+
+    return temp_list
+
+
+def collect_credentials():
+    # Prompt for user credentials
+    global usernames
+    username, password, enablepw = user_credentials()
+    usernames = [[username, password, enablepw]]
+
+    # Offer to check additional credentials
+    user_message = Fore.CYAN + "\nWould you like to check additional credentials? (y/n) " + Fore.WHITE
+    additional_check = input(user_message)
+    if additional_check.lower() == 'y':
+        usernames = additional_creds()
+
+    # Jump host password if no key file is configured
+    global jump_password
+    if jump_host != '' and jump_key_file == '':
+        jump_password = getpass.getpass("\nJump host password (blank to use SSH agent): ")
+
+
 def user_credentials():
     # Get user credentials to test
     print(Fore.CYAN + "Please enter credentials to check." + Fore.WHITE)
     username = input("\nUsername: ")
     password = getpass.getpass("Password: ")
     enablepw = password
+    if check_enable:
+        enablepw = getpass.getpass("Enable secret (blank to use password): ") or password
 
     return username, password, enablepw
 
@@ -212,7 +625,7 @@ def additional_creds():
     return usernames
 
 
-def online_device_add(device):
+def online_device_add(device, device_count):
     # Function to check if device is online
 
     # Checks host OS type and pings remote devices to determine availability
@@ -225,98 +638,969 @@ def online_device_add(device):
     if response == 0:
         device_list.append(str(device))
 
-    # Release thread to pool
-    sema.release()
 
+def test(device, device_count, done):
+    # Checks a device, calling done() once it has been reported
+    # Telnet logins finish on the Telnet loop after this returns, so the
+    # worker thread is free for the next device
+    check = new_check(device, device_count)
+    # Skip devices already checked under another address
+    if dedupe_by_host_key:
+        original = claim_identity(device)
+        if original is not None:
+            check['auth_type'] = "Duplicate of " + original
+            report_result(check)
+            done()
+            return
+
+    def checked():
+        try:
+            test_finished(check)
+        finally:
+            done()
+    check_device(check, checked)
+
+
+def test_finished(check):
+    device = check['device']
+    # Failures while AAA is overloaded may not be the credentials' fault
+    # A single unanswered login isn't overload, only retry while saturated
+    if check['auth_type'] != "Telnet" and check['auth_type'] != "SSH":
+        if aaa_monitor.saturated() and (
+                check['auth_status'] == "timeout" or check['error'] in ("auth_rejected", "timeout")):
+            check['auth_type'] = "Retry - AAA servers overloaded"
+            retry_list.append(device)
+    breaker.record(outcome_class(check))
+
+    report_result(check)
+
+
+def new_check(device, device_count):
+    # Results of a check, filled in as each connection is attempted
+    return {
+        'device': device,
+        'index': device_count,
+        'started': time.time(),
+        'address': device,
+        'auth_type': "",
+        'auth_status': "",
+        'enable': "",
+        'transport': "",
+        'error': "",
+        'exception': "",
+        'timings': {},
+        'host_key': "",
+        'host_key_changed': False,
+        'inventory': {},
+        # Timeouts used for this device and times measured for learning them
+        'timeouts': {'connect': connect_timeout, 'ssh_banner': telnet_timeout, 'telnet_auth': telnet_timeout},
+        'samples': {},
+        'ports': {'ssh': 22, 'telnet': 23},
+    }
+
+
+def check_device(check, done):
+    # Log in to the device over SSH, then Telnet if SSH didn't give an answer
+    # SSH runs in this thread, Telnet on the Telnet loop; done() is called
+    # when the check is complete, from whichever finished it
+    device = check['device']
+    # Use the device's profile if one was given in devices.txt, otherwise
+    # the one detected from its banners on an earlier check
+    profile_name = device_info.get(device, {}).get('profile') or state['profiles'].get(device)
+    if profile_name not in profiles:
+        profile_name = None
+    check['profile'] = profile_name
+    check['ports'] = device_ports(device)
+
+    # Resolve hostnames once for both SSH and Telnet
+    phase_start = time.time()
+    try:
+        check['address'] = resolve(device)
+    except Exception as error:
+        # The jump host may be able to resolve names we can't
+        if jump_host == '':
+            record_error(check, error)
+    check['timings']['resolve'] = time.time() - phase_start
+    if adaptive_timeouts:
+        check['timeouts'] = device_timeouts(device, check['address'])
+
+    # A DNS failure ends the check, neither protocol could connect
+    if check['error'] == "":
+        ssh_check(check)
+        # Try Telnet unless SSH gave a definite answer, the device can't be
+        # reached or AAA didn't answer the SSH login
+        if (check['auth_type'] == "" and check['error'] not in ("auth_rejected", "unreachable", "jump_failed")
+                and check['auth_status'] != "timeout"):
+            if jump_host == '' and check['ports']['telnet'] is not None:
+                telnet_check(check, lambda: check_finished(check, done))
+                return
+    check_finished(check, done)
+
+
+def check_finished(check, done):
+    try:
+        if adaptive_timeouts:
+            learn_timeouts(check)
+    finally:
+        done()
 
-def test(device,device_count):
-    auth_type = ""
 
-    # Use a try, so it doesn't throw an exception and cancel out of the script.
+def resolve(device):
+    # First address of a host name or IPv4/IPv6 literal, in the system's
+    # preferred order so hosts with only AAAA records are reached too
+    return socket.getaddrinfo(device, None, 0, socket.SOCK_STREAM)[0][4][0]
+
+
+def device_ports(device):
+    # SSH and Telnet ports from devices.txt, None for a protocol not to try
+    # Devices that declare a port or a transport only get what they declare
+    tags = device_info.get(device, {})
+    ports = {'ssh': 22, 'telnet': 23}
+    if 'transport' in tags:
+        wanted = tags['transport'].lower().split(",")
+    else:
+        wanted = [protocol for protocol in ports if protocol in tags] or list(ports)
+    for protocol in ports:
+        if protocol not in wanted:
+            ports[protocol] = None
+        elif tags.get(protocol, "").isdigit():
+            ports[protocol] = int(tags[protocol])
+    return ports
+
+
+def timeout_key(address):
+    # Subnet a device's timeouts are learned for along with its own
     try:
-        # We need to set the various options Netmiko is expecting. 
-        # We use the variables we got from the user earlier
-        network_device_param = {
-            'device_type': 'cisco_ios_ssh',
-            'ip': device,
-            'username': username,
-            'password': password,
-            'secret': enablepw,
-        }
-        # This command is when we are attempting to connect. If it fails, it will move on to the except block below
-        # Use RedirectStdStreams to filter any output errors from connection resets
-        with RedirectStdStreams(stderr=devnull):
-            net_connect = ConnectHandler(**network_device_param)
-        # This variable will be used to report successful connections
-        auth_type = "SSH"
-        # Close session
-        net_connect.disconnect()
-    except:
-        try:
-            # Here we are saying "if ssh failed, TRY telnet"
-            # Use telnetlib to attempt to connect
-            tn = telnetlib.Telnet(device,23,2)
-            # Listen for username prompt and send username
-            tn.read_until(b"Username: ",2)
-            tn.write(username.encode('ascii') + b"\n")
-            # Listen for password prompt and send password
-            tn.read_until(b"Password: ",2)
-            tn.write(password.encode('ascii') + b"\n")
-            # Check output to verify successful connection
-            conn_output = tn.read_until(b"#",2)
-            if b"password>" in conn_output:
-                # Arris modem password prompt
-                # Send password
-                tn.write(password.encode('ascii') + b"\n")
-                # Check output to verify successful connection
-                arris_output = tn.read_until(b"Console>",2)
-                if b"Console>" in arris_output:
-                    # This variable will be used to report successful connections
-                    auth_type = "Telnet"
-                else:
-                    auth_type = "Credentials incorrect but Telnet open"
-                    user_message = Fore.MAGENTA + "   Credentials incorrect, but Telnet open." + Fore.WHITE
-            elif b"#" in conn_output:
-                # This variable will be used to report successful connections
-                auth_type = "Telnet"
-            elif b">" in conn_output:
-                # This variable will be used to report successful connections
-                auth_type = "Telnet"
+        return str(IPNetwork(address + "/" + str(adaptive_prefix_len)).cidr)
+    except Exception:
+        return None
+
+
+def device_timeouts(device, address):
+    # Timeouts learned for the device, or for its subnet if it is new
+    learned = state['timeouts'].get(device) or state['timeouts'].get(timeout_key(address)) or {}
+    # An SSH version string arrives in milliseconds while a Telnet login
+    # waits for AAA, so each kind is learned on its own
+    timeouts = {'connect': connect_timeout, 'ssh_banner': telnet_timeout, 'telnet_auth': telnet_timeout}
+    for kind in timeouts:
+        if kind in learned:
+            average, variation = learned[kind]
+            timeout = min(adaptive_max_timeout, max(adaptive_min_timeout, average + 4 * variation))
+            # Still shorten timeouts when a time budget requires it
+            if budget_deadline is not None:
+                timeout = min(timeout, timeouts[kind])
+            timeouts[kind] = timeout
+    return timeouts
+
+
+def learn_timeouts(check):
+    # Update the device's and subnet's timings with what this check measured
+    if not check['samples'] and check['error'] != "timeout":
+        return
+    keys = [check['device'], timeout_key(check['address'])]
+    with timeout_lock:
+        for key in keys:
+            if key is None:
+                continue
+            learned = state['timeouts'].setdefault(key, {})
+            for kind, sample in check['samples'].items():
+                if kind not in learned:
+                    learned[kind] = [sample, sample / 2]
+                    continue
+                # Smoothed time and variation, weighted as TCP does
+                average, variation = learned[kind]
+                variation = 0.75 * variation + 0.25 * abs(sample - average)
+                average = 0.875 * average + 0.125 * sample
+                learned[kind] = [average, variation]
+            # Give a device that timed out longer next time
+            if check['error'] == "timeout" and key == check['device']:
+                for kind in learned:
+                    learned[kind] = [min(adaptive_max_timeout, learned[kind][0] * 2), learned[kind][1]]
+
+
+def ssh_check(check):
+    # Attempt to log in over SSH
+    # The SSH port is opened here first so a refused or unreachable device is
+    # known in milliseconds instead of after netmiko's timeouts
+    if profiles[check['profile'] or default_profile]['device_type'] is None:
+        # Profile has no SSH driver, go straight to Telnet
+        return
+    if check['ports']['ssh'] is None:
+        # Device is only reachable over Telnet
+        return
+    if ssh_backend == 'openssh':
+        openssh_check(check)
+        return
+
+    phase_start = time.time()
+    try:
+        sock = open_ssh_socket(check['address'], check['ports']['ssh'], check['timeouts']['connect'])
+    except Exception as error:
+        check['timings']['ssh_connect'] = time.time() - phase_start
+        record_error(check, error)
+        return
+    check['timings']['ssh_connect'] = time.time() - phase_start
+    check['samples']['connect'] = check['timings']['ssh_connect']
+    check['transport'] = "ssh"
+
+    # Pick the device type from the SSH version string the device sends
+    if check['profile'] is None and jump_host == '':
+        phase_start = time.time()
+        version = peek_ssh_version(sock, check['timeouts']['ssh_banner'])
+        if version != "":
+            check['samples']['ssh_banner'] = time.time() - phase_start
+        detected = detect_profile(version, 'ssh_banner')
+        if detected is not None:
+            check['profile'] = detected
+            state['profiles'][check['device']] = detected
+            if profiles[detected]['device_type'] is None:
+                close_ssh_socket(sock)
+                return
+    profile = profiles[check['profile'] or default_profile]
+
+    # We need to set the various options Netmiko is expecting. 
+    # We use the variables we got from the user earlier
+    network_device_param = {
+        'device_type': profile['device_type'],
+        'ip': check['address'],
+        'port': check['ports']['ssh'],
+        'username': username,
+        'password': password,
+        'secret': enablepw,
+        'sock': sock,
+    }
+    # Wait for the SSH banner as long as for any other prompt
+    if adaptive_timeouts:
+        network_device_param['banner_timeout'] = check['timeouts']['ssh_banner']
+    # Connection reset errors are filtered by quiet_ssh_logging()
+    # The host key is recorded by netmiko's host key policy during the
+    # handshake, so it is known even if the login fails. The policy also
+    # marks the end of key exchange, so AAA latency covers only the login
+    # and not key exchange or netmiko's session preparation
+    phase_start = time.time()
+    check['auth_started'] = None
+    try:
+        net_connect = load_backend('ssh').ConnectHandler(auto_connect=False, **network_device_param)
+        net_connect.key_policy = HostKeyRecorder(check)
+        net_connect._modify_connection_params()
+        net_connect.establish_connection()
+    except Exception as error:
+        check['timings']['ssh'] = time.time() - phase_start
+        close_ssh_socket(sock)
+        record_error(check, error)
+        # Only count logins that reached AAA
+        if check['auth_started'] is not None and check['error'] in ("auth_rejected", "timeout"):
+            auth_latency = time.time() - check['auth_started']
+            check['timings']['auth'] = auth_latency
+            if check['error'] == "auth_rejected":
+                check['auth_type'] = "Credentials incorrect but SSH open"
+                aaa_monitor.record(auth_latency, "rejected")
             else:
-                auth_type = "Credentials incorrect but Telnet open"
-                user_message = Fore.MAGENTA + "   Credentials incorrect, but Telnet open." + Fore.WHITE
-            # Close Telnet sesstion
-            tn.close
-        except:
-            # This is the catch all except, if NOTHING works, tell the 
-            # user and continue onto the next item in the for loop.
-            user_message = Fore.MAGENTA + "   Unable to connect." + Fore.WHITE
-
-    # Lock output to this thread
-    screenlock.acquire()
-
-    # Add connection result to log
-    file = open(logname, 'a')
-    file.write(device + "," + auth_type + "\n")
-    file.close()
-
-    # Prints connection result to screen
-    # Create a heading so if there are multiple devices, you know what the output is for
-    print ("\n----------------------------\n" + 
-        str(device) + " - " + 
-        str(threading.active_count()) + 
-        " threads\n----------------------------\n"
-    )
+                check['auth_status'] = "timeout"
+                aaa_monitor.record(auth_latency, "timeout")
+        return
+    auth_latency = time.time() - (check['auth_started'] or phase_start)
+    check['timings']['auth'] = auth_latency
+    aaa_monitor.record(auth_latency, "ok")
+    # This variable will be used to report successful connections
+    check['auth_type'] = "SSH"
+    check['error'] = ""
+    check['exception'] = ""
+    # The credentials were accepted, a device that then never shows a usable
+    # prompt is a protocol problem and not an AAA timeout
+    try:
+        net_connect._try_session_preparation()
+    except Exception as error:
+        check['timings']['ssh'] = time.time() - phase_start
+        check['error'] = "protocol_error"
+        check['exception'] = type(error).__name__
+        close_ssh_socket(sock)
+        return
+    check['timings']['ssh'] = time.time() - phase_start
+    # Check the enable secret before closing the session
+    if check_enable:
+        phase_start = time.time()
+        check['enable'] = ssh_enable_check(net_connect)
+        check['timings']['enable'] = time.time() - phase_start
+    # Collect inventory on the open session
+    if inventory_commands:
+        phase_start = time.time()
+        check['inventory'] = ssh_inventory(net_connect)
+        check['timings']['inventory'] = time.time() - phase_start
+    # Close session
+    net_connect.disconnect()
+    close_ssh_socket(sock)
+
+
+def openssh_check(check):
+    # Attempt to log in using the system OpenSSH client
+    if jump_host == '':
+        # Check the SSH port first so refused and unreachable devices fail fast
+        phase_start = time.time()
+        try:
+            socket.create_connection((check['address'], check['ports']['ssh']), check['timeouts']['connect']).close()
+        except Exception as error:
+            check['timings']['ssh_connect'] = time.time() - phase_start
+            record_error(check, error)
+            return
+        check['timings']['ssh_connect'] = time.time() - phase_start
+        check['samples']['connect'] = check['timings']['ssh_connect']
+    check['transport'] = "ssh"
+
+    # ssh adds the device's key to an empty known_hosts file of its own,
+    # which is where its fingerprint is read from. The jump host connection
+    # logs to its own file so its errors aren't taken for the device's
+    known_fd, known_hosts = tempfile.mkstemp(prefix="known-hosts-", dir=get_openssh_dir())
+    os.close(known_fd)
+    proxy_log = None
+    if jump_host != '':
+        log_fd, proxy_log = tempfile.mkstemp(prefix="jump-", suffix=".log", dir=get_openssh_dir())
+        os.close(log_fd)
+    command = openssh_arguments(check['address'], check['ports']['ssh'], check['timeouts']['connect'], known_hosts, proxy_log)
+    # Passwords are handed to the askpass scripts through the environment
+    environment = dict(os.environ,
+        SSH_ASKPASS=os.path.join(get_openssh_dir(), "askpass"),
+        SSH_ASKPASS_REQUIRE="force",
+        DISPLAY=os.environ.get('DISPLAY', "none"),
+        CREDENTIAL_CHECK_PASSWORD=password,
+        CREDENTIAL_CHECK_JUMP_PASSWORD=jump_password)
+    auth_start = time.time()
+    try:
+        process = subprocess.run(command, env=environment, stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=openssh_timeout)
+    except subprocess.TimeoutExpired:
+        check['timings']['ssh'] = time.time() - auth_start
+        check['error'] = "timeout"
+        check['exception'] = "TimeoutExpired"
+        return
+    finally:
+        # The key is known once key exchange finished, even if login failed
+        with open(known_hosts) as known_hosts_file:
+            for line in known_hosts_file:
+                fields = line.split()
+                if len(fields) >= 3:
+                    record_host_key(check, key_fingerprint(base64.b64decode(fields[2])))
+                    break
+        os.remove(known_hosts)
+        proxy_output = ""
+        if proxy_log is not None:
+            with open(proxy_log, errors='replace') as log_file:
+                proxy_output = log_file.read()
+            os.remove(proxy_log)
+    check['timings']['ssh'] = time.time() - auth_start
+    stderr = process.stderr.decode('utf-8', 'replace')
+
+    # Logged in once ssh reports authenticating to the device (not the jump
+    # host), even if the device then refuses to run the command. Otherwise
+    # ssh exits with 255 for its own errors, anything else came from the device
+    authenticated = re.search(r"^Authenticated to " + re.escape(check['address']) + r" ", stderr, re.MULTILINE)
+    if authenticated is not None or process.returncode != 255:
+        aaa_monitor.record(time.time() - auth_start, "ok")
+        check['auth_type'] = "SSH"
+        check['error'] = ""
+        check['exception'] = ""
+        return
+    check['error'] = classify_openssh_error(stderr)
+    check['exception'] = "ssh exit 255"
+    if check['error'] != "auth_rejected" and proxy_output.strip() != "":
+        # The jump host couldn't reach the device, or couldn't be used at all
+        # Through the shared connection ssh doesn't say why a channel failed
+        channel = re.search(r"(?:open failed|forwarding request failed): (.*)", proxy_output)
+        if channel is not None:
+            check['error'] = classify_openssh_error(channel.group(1))
+        else:
+            check['error'] = "jump_failed"
+    if check['error'] == "auth_rejected":
+        check['auth_type'] = "Credentials incorrect but SSH open"
+        aaa_monitor.record(time.time() - auth_start, "rejected")
+
+
+def openssh_arguments(address, port, timeout, known_hosts=os.devnull, proxy_log=None):
+    # ssh command line for a login check
+    # Each device login is its own connection; only the jump host
+    # connection is shared, through a control socket. The jump host gets
+    # its own askpass and never sees the password being checked
+    command = [openssh_command, "-T",
+        "-o", "ConnectTimeout=" + str(max(1, int(timeout + 0.5))),
+        "-o", "NumberOfPasswordPrompts=1",
+        "-o", "PreferredAuthentications=password,keyboard-interactive",
+        "-o", "PubkeyAuthentication=no",
+        "-o", "StrictHostKeyChecking=no",
+        "-o", "UserKnownHostsFile=" + known_hosts.replace("%", "%%"),
+        "-o", "LogLevel=VERBOSE",
+        "-o", "ControlMaster=no",
+        "-p", str(port),
+        "-l", username]
+    if jump_host != '':
+        # Reach the device through a master connection to the jump host
+        openssh_dir = get_openssh_dir().replace("%", "%%")
+        proxy = ["env", "-u", "CREDENTIAL_CHECK_PASSWORD",
+            "SSH_ASKPASS=" + os.path.join(openssh_dir, "jump-askpass"),
+            openssh_command, "-W", "%h:%p",
+            "-o", "ConnectTimeout=" + str(max(1, int(timeout + 0.5))),
+            "-o", "NumberOfPasswordPrompts=1",
+            "-o", "StrictHostKeyChecking=yes",
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=" + os.path.join(openssh_dir, "jump-%%C"),
+            "-o", "ControlPersist=" + str(openssh_persist),
+            "-p", str(jump_port),
+            "-l", jump_username or username, jump_host]
+        if jump_password == '':
+            # Key or agent only, never prompt
+            proxy[5:5] = ["-o", "BatchMode=yes"]
+        if jump_key_file != '':
+            proxy[5:5] = ["-i", jump_key_file]
+        if proxy_log is not None:
+            proxy[5:5] = ["-E", proxy_log.replace("%", "%%")]
+        # %%C is left for the jump connection to expand, ProxyCommand itself
+        # only knows %h, %p, %r and %n
+        command += ["-o", "ProxyCommand=" + " ".join(shlex.quote(argument) for argument in proxy)]
+    return command + openssh_options + [address, "exit"]
+
+
+def classify_openssh_error(stderr):
+    # Sort ssh error output into the same classes as classify_error()
+    message = stderr.lower()
+    if "permission denied" in message or "too many authentication failures" in message:
+        return "auth_rejected"
+    if "could not resolve hostname" in message:
+        return "dns_failure"
+    if "connection refused" in message:
+        return "refused"
+    if "no route to host" in message or "network is unreachable" in message:
+        return "unreachable"
+    if "timed out" in message:
+        return "timeout"
+    return "protocol_error"
+
+
+def get_openssh_dir():
+    # Private directory for the askpass scripts, control sockets, jump host
+    # logs and known_hosts files
+    global openssh_dir
+    with backend_lock:
+        if openssh_dir is None:
+            openssh_dir = tempfile.mkdtemp(prefix="credcheck-")
+            for name, variable in (("askpass", "CREDENTIAL_CHECK_PASSWORD"), ("jump-askpass", "CREDENTIAL_CHECK_JUMP_PASSWORD")):
+                askpass = os.path.join(openssh_dir, name)
+                with open(askpass, 'w') as fn:
+                    fn.write("#!/bin/sh\nprintf '%s\\n' \"$" + variable + "\"\n")
+                os.chmod(askpass, 0o700)
+    return openssh_dir
+
+
+# Used to record SSH host keys during the handshake
+# Stands in for netmiko's AutoAddPolicy, which accepts any key
+class HostKeyRecorder(object):
+    def __init__(self, check):
+        self.check = check
+
+    def missing_host_key(self, client, hostname, key):
+        # Key exchange is done, authentication starts next
+        self.check['auth_started'] = time.time()
+        record_host_key(self.check, key_fingerprint(key.asbytes()))
+
+
+def key_fingerprint(key):
+    # OpenSSH style SHA256 fingerprint of a host key blob
+    return "SHA256:" + base64.b64encode(hashlib.sha256(key).digest()).decode('ascii').rstrip("=")
+
+
+def record_host_key(check, fingerprint):
+    # Save a device's host key fingerprint, flagging it if it changed
+    device = check['device']
+    check['host_key'] = fingerprint
+    previous = state['host_keys'].get(device)
+    if previous is not None and previous != fingerprint:
+        check['host_key_changed'] = True
+    state['host_keys'][device] = fingerprint
+    with identity_lock:
+        run_identities.setdefault(fingerprint, device)
+
+
+def claim_identity(device):
+    # Returns the device already checked with the same host key, if any,
+    # otherwise marks this device as the one checked for its host key
+    fingerprint = state['host_keys'].get(device)
+    if fingerprint is None:
+        return None
+    with identity_lock:
+        original = run_identities.setdefault(fingerprint, device)
+    if original == device:
+        return None
+    return original
+
+
+def peek_ssh_version(sock, timeout):
+    # Returns the SSH version line the device sent, leaving it unread for
+    # netmiko, or an empty string if none arrived in time
+    sock.settimeout(timeout)
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            data = sock.recv(1024, socket.MSG_PEEK)
+            if data == b"":
+                break
+            version = re.search(b"^SSH-[^\r\n]*(?=\r?\n)", data, re.MULTILINE)
+            if version is not None:
+                return version.group().decode('ascii', 'replace')
+            time.sleep(0.01)
+    except (OSError, ValueError):
+        pass
+    return ""
+
+
+def detect_profile(banner, key):
+    # Returns the first profile whose banner pattern (ssh_banner or
+    # telnet_banner) matches, or None
+    if banner == "":
+        return None
+    for name in sorted(profiles):
+        pattern = profiles[name].get(key + '_regex')
+        if pattern is not None and pattern.search(banner):
+            return name
+    return None
+
+
+def open_ssh_socket(address, port, timeout):
+    # Connection to the SSH port, direct or as a channel through the jump host
+    if jump_host != '':
+        return get_jump_pool().open_channel(address, port)
+    return socket.create_connection((address, port), timeout)
+
+
+def close_ssh_socket(sock):
+    if jump_host != '':
+        jump_pool.release(sock)
+    else:
+        sock.close()
+
 
-    if auth_type != "":
-        if auth_type != "Credentials incorrect but Telnet open":
-            user_message = Fore.MAGENTA + "   " + str(device) + " accessible via " + str(auth_type) + "!" + Fore.WHITE
-    print(user_message)
+def telnet_check(check, done):
+    # Attempt to log in over Telnet
+    # The session runs on the shared Telnet loop, which calls
+    # telnet_finished() and then done() when it ends
+    if check['profile'] is None:
+        # Answer login prompts of any known profile if none was given
+        matcher = combined_matcher
+    else:
+        matcher = profiles[check['profile']]['matcher']
+    phase_start = time.time()
+    record = check['device'] in transcript_devices or device_info.get(check['device'], {}).get('transcript', '').lower() in ('yes', 'true')
+    def finished(session):
+        try:
+            telnet_finished(check, session, phase_start)
+        finally:
+            done()
+    get_telnet_loop().submit(check['address'], check['ports']['telnet'], telnet_steps(check, matcher),
+        record, check['timeouts']['connect'], finished)
 
-    # Release screenlock
-    screenlock.release()
-    # Release thread to pool
-    sema.release()
+
+def telnet_finished(check, session, phase_start):
+    if session.transcript:
+        save_transcript(check, session)
+
+    if session.connect_time is None:
+        check['timings']['telnet_connect'] = time.time() - phase_start
+    else:
+        check['timings']['telnet_connect'] = session.connect_time
+        check['samples']['connect'] = session.connect_time
+        check['transport'] = "telnet"
+    if session.error is not None:
+        # Connection failed or dropped part way through the login
+        record_error(check, session.error)
+
+
+def telnet_steps(check, matcher):
+    # Telnet session run by the Telnet loop
+    # Each yield gives the data to send, the prompt to wait for and the timeout
+    phase_start = time.time()
+    auth_status, prompt, auth_latency, banner = yield from telnet_login(matcher, check['timeouts']['telnet_auth'])
+    check['timings']['telnet_login'] = time.time() - phase_start
+    check['auth_status'] = auth_status
+    # Remember the device's profile if its banner identifies it
+    if check['profile'] is None:
+        detected = detect_profile(banner.decode('ascii', 'replace'), 'telnet_banner')
+        if detected is not None:
+            check['profile'] = detected
+            state['profiles'][check['device']] = detected
+    if auth_status == "ok":
+        # This variable will be used to report successful connections
+        check['auth_type'] = "Telnet"
+        check['error'] = ""
+        check['exception'] = ""
+        if check_enable and prompt['enable']:
+            if prompt['text'].endswith(b"#"):
+                # Already privileged, no enable needed
+                check['enable'] = "Privileged"
+            else:
+                # Check the enable secret before closing the session
+                phase_start = time.time()
+                check['enable'] = yield from telnet_enable_check(check['timeouts']['telnet_auth'])
+                check['timings']['enable'] = time.time() - phase_start
+        # Collect inventory on the open session
+        if inventory_commands and prompt['line'] != b"":
+            phase_start = time.time()
+            check['inventory'] = yield from telnet_inventory(prompt)
+            check['timings']['inventory'] = time.time() - phase_start
+    elif auth_status == "timeout":
+        # No answer after the password, AAA may be slow
+        check['error'] = "timeout"
+        check['exception'] = ""
+    elif auth_status == "noprompt":
+        # Port open but no login prompt, no credentials were sent
+        check['error'] = "protocol_error"
+        check['exception'] = ""
+    else:
+        check['auth_type'] = "Credentials incorrect but Telnet open"
+        check['error'] = "auth_rejected"
+        check['exception'] = ""
+    # Only logins that reached the password stage involve AAA
+    if auth_latency is not None:
+        check['timings']['auth'] = auth_latency
+        if auth_status != "timeout":
+            check['samples']['telnet_auth'] = auth_latency
+        aaa_monitor.record(auth_latency, auth_status)
+
+
+def save_transcript(check, session):
+    # Write a recorded Telnet session to transcript_dir without credentials
+    secrets = [(password, b"<password>"), (enablepw, b"<enable>"), (username, b"<username>")]
+    # Longest first so a password containing the username is still hidden
+    secrets.sort(key=lambda secret: len(secret[0]), reverse=True)
+    # Adjacent chunks in the same direction are joined first so a secret
+    # split across reads (e.g. echoed a character at a time) is still found
+    runs = []
+    for offset, direction, data in session.transcript:
+        if runs and runs[-1][1] == direction:
+            runs[-1][2] += data
+        else:
+            runs.append([offset, direction, data])
+    events = []
+    for offset, direction, data in runs:
+        for secret, placeholder in secrets:
+            if secret != "":
+                data = data.replace(secret.encode('ascii'), placeholder)
+        # latin-1 maps every byte to one character so nothing is lost
+        events.append([offset, direction, data.decode('latin-1')])
+    transcript = {
+        'device': check['device'],
+        'address': session.address,
+        'port': session.port,
+        'profile': check['profile'] or "",
+        'credential': cred_label,
+        'result': check['auth_type'],
+        'recorded': datetime.now().isoformat(),
+        'events': events,
+    }
+    if not os.path.isdir(transcript_dir):
+        os.makedirs(transcript_dir, exist_ok=True)
+    name = check['device'] + "_" + strftime("%Y-%m-%d_%H%M%S") + "_" + str(cred_index + 1) + ".json"
+    with open(os.path.join(transcript_dir, name), 'w') as transcript_file:
+        json.dump(transcript, transcript_file, indent=1)
+
+
+def replay():
+    # Serve every transcript in transcript_dir on its own loopback address
+    names = sorted(name for name in os.listdir(transcript_dir) if name.endswith(".json"))
+    servers = []
+    replay_list = open("replay_devices.txt", 'w')
+    for number, name in enumerate(names):
+        with open(os.path.join(transcript_dir, name)) as transcript_file:
+            transcript = json.load(transcript_file)
+        address = "127.0." + str(1 + number // 254) + "." + str(1 + number % 254)
+        server = ReplayServer((address, replay_port), ReplayHandler)
+        server.transcript = transcript
+        thread = threading.Thread(target=server.serve_forever, name="replay-" + str(number + 1))
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+        # Addresses are tagged with the port if it isn't the Telnet default
+        if replay_port != 23:
+            replay_list.write(address + " telnet=" + str(replay_port) + "\n")
+        else:
+            replay_list.write(address + "\n")
+        print(Fore.MAGENTA + "   " + address + " - " + name + " (" + transcript['result'] + ")" + Fore.WHITE)
+    replay_list.close()
+    print(Fore.MAGENTA + "\nReplaying " + str(len(servers)) + " transcripts, addresses saved to replay_devices.txt" + Fore.WHITE)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def record_error(check, error):
+    # Save the class of a connection error for reporting
+    check['error'] = classify_error(error)
+    check['exception'] = type(error).__name__
+
+
+def classify_error(error):
+    # Sort connection errors into refused, unreachable, timeout,
+    # auth_rejected, dns_failure and protocol_error
+    if isinstance(error, socket.gaierror):
+        return "dns_failure"
+    if isinstance(error, ConnectionRefusedError):
+        return "refused"
+    if isinstance(error, socket.timeout):
+        return "timeout"
+    if isinstance(error, OSError) and error.errno in (errno.EHOSTUNREACH, errno.ENETUNREACH):
+        return "unreachable"
+    # netmiko and paramiko exceptions
+    name = type(error).__name__
+    if name == "JumpHostError":
+        return "jump_failed"
+    if name == "ChannelException":
+        # Jump host couldn't open a connection to the device
+        reason = str(getattr(error, 'text', error)).lower()
+        if "refused" in reason:
+            return "refused"
+        if "unreachable" in reason or "no route" in reason:
+            return "unreachable"
+        if "timed out" in reason:
+            return "timeout"
+        return "protocol_error"
+    if "Authentication" in name:
+        # paramiko raises "Authentication timeout." when AAA doesn't answer
+        if "authentication timeout" in str(error).lower():
+            return "timeout"
+        return "auth_rejected"
+    if "Timeout" in name:
+        return "timeout"
+    return "protocol_error"
+
+
+def report_result(check, quiet=False):
+    device = check['device']
+    auth_type = check['auth_type']
+
+    # Keep the result for the summary
+    results.add(check['index'], cred_index, outcome_class(check), check['transport'], time.time() - check['started'])
+    if auth_type == "SSH" or auth_type == "Telnet":
+        state['verified'][device] = time.time()
+
+    # Message for screen output
+    if auth_type == "SSH" or auth_type == "Telnet":
+        user_message = Fore.MAGENTA + "   " + str(device) + " accessible via " + str(auth_type) + "!" + Fore.WHITE
+        if check['enable'] != "":
+            user_message = user_message + Fore.MAGENTA + " Enable: " + check['enable'] + Fore.WHITE
+    elif auth_type == "Credentials incorrect but Telnet open":
+        user_message = Fore.MAGENTA + "   Credentials incorrect, but Telnet open." + Fore.WHITE
+    elif auth_type == "Credentials incorrect but SSH open":
+        user_message = Fore.MAGENTA + "   Credentials incorrect, but SSH open." + Fore.WHITE
+    elif auth_type.startswith("Retry"):
+        user_message = Fore.MAGENTA + "   AAA servers overloaded, marked for retry." + Fore.WHITE
+    elif auth_type.startswith("Duplicate"):
+        user_message = Fore.MAGENTA + "   Same device as " + auth_type[len("Duplicate of "):] + ", skipped." + Fore.WHITE
+    elif check['error'] == "dns_failure":
+        user_message = Fore.MAGENTA + "   Unable to resolve." + Fore.WHITE
+    else:
+        user_message = Fore.MAGENTA + "   Unable to connect (" + check['error'] + ")." + Fore.WHITE
+    if check.get('host_key_changed'):
+        user_message = user_message + Fore.YELLOW + "\n   Warning: SSH host key has changed since the last run!" + Fore.WHITE
+
+    # Lock output to this thread, released even if writing the log fails
+    with screenlock:
+        # Add connection result to log
+        if check_enable:
+            row = device + "," + auth_type + "," + check['enable'] + "\n"
+        else:
+            row = device + "," + auth_type + "\n"
+        if partitions is not None:
+            partitions.write(check, row)
+        else:
+            file = open(logname, 'a')
+            file.write(row)
+            file.close()
+        if check.get('inventory'):
+            save_inventory(check)
+
+        # Stream result to JSON Lines output
+        record = {
+            'device': device,
+            'address': check['address'],
+            'credential': cred_label,
+            'outcome': outcome_class(check),
+            'result': auth_type,
+            'transport': check['transport'],
+            'enable': check['enable'],
+            'timings': dict((phase, round(seconds, 4)) for phase, seconds in check['timings'].items()),
+            'error': check['error'],
+            'exception': check['exception'],
+            'host_key': check.get('host_key', ""),
+            'host_key_changed': check.get('host_key_changed', False),
+            'profile': check.get('profile') or "",
+        }
+        if check.get('inventory'):
+            record['inventory'] = check['inventory']
+        if jsonl_file is not None:
+            jsonl_file.write(json.dumps(record) + "\n")
+            jsonl_file.flush()
+        # Keep the result for the daemon job being run
+        if current_job is not None:
+            current_job['results'].append(record)
+
+        # Devices skipped by the time budget are only counted on screen
+        if quiet:
+            return
+
+        # Prints connection result to screen
+        # Create a heading so if there are multiple devices, you know what the output is for
+        print ("\n----------------------------\n" + 
+            str(device) + " - " + 
+            str(threading.active_count()) + 
+            " threads\n----------------------------\n"
+        )
+        print(user_message)
+
+
+def outcome_class(check):
+    # Short outcome name for a check, the error class when it failed
+    auth_type = check['auth_type']
+    if auth_type == "SSH" or auth_type == "Telnet":
+        return "success"
+    if auth_type.startswith("Retry"):
+        return "retry"
+    if auth_type.startswith("Credentials incorrect"):
+        return "auth_rejected"
+    if auth_type.startswith("Not checked"):
+        return "not_checked"
+    if auth_type.startswith("Duplicate"):
+        return "duplicate"
+    if auth_type.startswith("Stopped"):
+        return "stopped"
+    return check['error'] or "unreachable"
+
+
+def ssh_enable_check(net_connect):
+    # Enter enable mode on an open SSH session using the enable secret
+    try:
+        if net_connect.check_enable_mode():
+            return "Privileged"
+        net_connect.enable()
+        if net_connect.check_enable_mode():
+            return "Accepted"
+    except Exception:
+        pass
+    return "Rejected"
+
+
+def telnet_login(matcher, timeout):
+    # Answers login prompts until a device prompt, a repeated login prompt or
+    # a timeout. Returns the status ("ok", "rejected", "timeout" or
+    # "noprompt"), the matched prompt, the time taken after the password and
+    # the banner sent before the first login prompt
+    answered = []
+    banner = None
+    password_time = None
+    password_output = b""
+    send = b""
+    while True:
+        match, text = yield send, matcher['regex'], timeout
+        send = b""
+        if banner is None:
+            banner = text
+        if password_time is not None:
+            password_output += text
+        if match is None:
+            if password_time is None:
+                return "noprompt", None, None, banner
+            # No reply at all after the password means AAA never answered
+            if password_output.strip() == b"":
+                return "timeout", None, time.time() - password_time, banner
+            return "rejected", None, time.time() - password_time, banner
+
+        prompt = matcher['groups'][match.lastgroup]
+        if prompt['kind'] == 'success':
+            # Ignore banners that look like prompts before logging in
+            if password_time is None:
+                continue
+            # Keep the whole prompt line to know when commands finish
+            prompt = dict(prompt, text=match.group(), line=text[text.rfind(b"\n") + 1:].strip())
+            return "ok", prompt, time.time() - password_time, banner
+        if prompt['kind'] == 'failure' or prompt['pattern'] in answered:
+            # Login failure message or login prompt asked again
+            if password_time is None:
+                return "rejected", None, None, banner
+            return "rejected", None, time.time() - password_time, banner
+
+        # Send the username or password the prompt asks for
+        answered.append(prompt['pattern'])
+        if prompt['send'] == 'username':
+            send = username.encode('ascii') + b"\n"
+        else:
+            send = password.encode('ascii') + b"\n"
+            if password_time is None:
+                password_time = time.time()
+
+
+# Prompts used to check the enable secret over Telnet
+enable_password_prompt = re.compile(b"assword: ")
+privileged_prompt = re.compile(b"#")
+
+
+def ssh_inventory(net_connect):
+    # Run the inventory commands on an open SSH session
+    # A command that fails or times out ends the collection, as later
+    # output could no longer be told apart
+    output = {}
+    for command in read_only_commands():
+        try:
+            output[command] = net_connect.send_command(command, read_timeout=inventory_timeout)
+        except Exception as error:
+            output[command] = "Error: " + type(error).__name__
+            break
+    return output
+
+
+def telnet_inventory(prompt):
+    # Run the inventory commands on an open Telnet session
+    output = {}
+    # Device prompt with either ending, enable may have changed it
+    device_prompt = re.compile(b"(?m)^" + re.escape(prompt['line'][:-1]) + b"[#>$%]\\s*$")
+    paging = profiles[prompt['profile']].get('paging')
+    if paging:
+        match, text = yield paging.encode('ascii') + b"\n", device_prompt, inventory_timeout
+        if match is None:
+            return output
+    for command in read_only_commands():
+        match, text = yield command.encode('ascii') + b"\n", device_prompt, inventory_timeout
+        if match is None:
+            output[command] = "Error: timeout"
+            break
+        # Drop the echoed command and the prompt that follows the output
+        lines = text[:match.start()].decode('utf-8', 'replace').splitlines()[1:]
+        output[command] = "\n".join(lines).strip("\n")
+    return output
+
+
+def read_only_commands():
+    # Inventory commands that only read from the device
+    return [command for command in inventory_commands if command.split() and command.split()[0].lower() in ('show', 'display')]
+
+
+def save_inventory(check):
+    # Write the inventory output of a device to inventory_dir
+    if not os.path.isdir(inventory_dir):
+        os.makedirs(inventory_dir, exist_ok=True)
+    inventory_log = open(os.path.join(inventory_dir, check['device'] + ".txt"), 'w')
+    for command, output in check['inventory'].items():
+        inventory_log.write("### " + command + "\n" + output + "\n\n")
+    inventory_log.close()
+
+
+def telnet_enable_check(timeout):
+    # Enter enable mode on an open Telnet session using the enable secret
+    match, enable_output = yield b"enable\n", enable_password_prompt, timeout
+    if match is not None:
+        match, enable_output = yield enablepw.encode('ascii') + b"\n", privileged_prompt, timeout
+    if enable_output.rstrip().endswith(b"#"):
+        return "Accepted"
+    return "Rejected"
 
 
 def connection_test():
@@ -326,31 +1610,79 @@ def connection_test():
     global file
     global logname
     logname = username + "_" + password[:3] + "_" + strftime("%Y-%m-%d_%H%M") +".csv"
-    file = open(logname, 'w')
-    # Add header information
-    file.write("device,authentication type\n")
-    # Close log after writing header; additional logs will be appended
-    file.close()
-
-    # This loop will test SSH then Telnet connections to every device in the list
-    threads = []
-    for device in device_list:
-        device_count = device_list.index(device)
-        my_thread = threading.Thread(target=test, args=(device,device_count,))
-        # Pull from pool of available threads
-        sema.acquire()
-        # Start thread
-        my_thread.start()
-        threads.append(my_thread)
-
-    # Joining will ensure all threads complete before continuing
-    main_thread = threading.currentThread()
-    for t in threads:
-        if t != main_thread:
-            t.join()
+    if check_enable:
+        header = "device,authentication type,enable\n"
+    else:
+        header = "device,authentication type\n"
+    # Results go to one file per partition if configured
+    global partitions
+    partitions = None
+    if partition_by:
+        partitions = PartitionWriter(logname[:-len(".csv")], header)
+    # A log from the same minute (watch mode, daemon jobs) is added to
+    elif not os.path.exists(logname):
+        file = open(logname, 'w')
+        # Add header information
+        file.write(header)
+        # Close log after writing header; additional logs will be appended
+        file.close()
+
+    # Track AAA server load for this credential set
+    global aaa_monitor, retry_list, breaker
+    aaa_monitor = AaaMonitor()
+    retry_list = []
+    # Stops the credential set if devices keep rejecting it
+    breaker = CircuitBreaker()
+    # Devices checked for each host key with this credential set
+    global run_identities
+    run_identities = {}
+
+    # Share what is left of the time budget between the remaining credential sets
+    planner = None
+    order = None
+    if budget_deadline is not None:
+        sets_left = len(usernames) - cred_index
+        deadline = time.time() + (budget_deadline - time.time()) / sets_left
+        planner = BudgetPlanner(deadline)
+        order = prioritize(device_list)
+
+    # This will test SSH then Telnet connections to every device in the list
+    # Devices are interleaved across sites so no single site gets every thread
+    scheduler = SiteScheduler(device_list, monitor=aaa_monitor, planner=planner, order=order, breaker=breaker)
+    scheduler.run(test, asynchronous=True)
+    if planner is not None:
+        planner.restore_timeouts()
+
+    # Log devices the circuit breaker or time budget didn't allow for
+    if breaker.tripped:
+        skipped_type = "Stopped - credentials rejected repeatedly"
+        user_message = "\n   Credential set stopped (" + breaker.reason + "), "
+    else:
+        skipped_type = "Not checked - time budget exceeded"
+        user_message = "\n   Time budget reached, "
+    for device, device_count in scheduler.skipped:
+        check = new_check(device, device_count)
+        check['auth_type'] = skipped_type
+        report_result(check, quiet=True)
+    if scheduler.skipped:
+        print(Fore.MAGENTA + user_message + str(len(scheduler.skipped)) +
+            " devices not checked." + Fore.WHITE
+        )
 
     # close log
-    file.close()
+    if partitions is not None:
+        partitions.close()
+
+    # Save devices to retry in devices.txt format
+    if retry_list:
+        retry_name = logname[:-len(".csv")] + "_retry.txt"
+        retry_log = open(retry_name, 'w')
+        for device in retry_list:
+            retry_log.write(device + "\n")
+        retry_log.close()
+        print(Fore.MAGENTA + "\n   " + str(len(retry_list)) +
+            " devices marked for retry due to AAA overload. Saved to " + retry_name + Fore.WHITE
+        )
 
 
 def summary():
@@ -368,28 +1700,1285 @@ def summary():
         Fore.WHITE
     )
 
+    # Outcome counts and check times for each credential set
+    stats = results.stats(len(usernames))
+    for cred_number, cred_stats in enumerate(stats):
+        if cred_number in canary_failed:
+            print(Fore.CYAN + "\n" + usernames[cred_number][0] + ": not scanned, rejected by every canary device" + Fore.WHITE)
+            continue
+        if cred_stats['total'] == 0:
+            continue
+        print(Fore.CYAN + "\n" + usernames[cred_number][0] + ": " + str(cred_stats['total']) + " checks" + Fore.WHITE)
+        for outcome in OUTCOMES:
+            if cred_stats['counts'][outcome]:
+                print("   " + outcome + ": " + str(cred_stats['counts'][outcome]))
+        if cred_stats['checked']:
+            print("   Check time p50/p90/p99: " +
+                "/".join(str(round(cred_stats['percentiles'][percent], 2)) + "s" for percent in (50, 90, 99))
+            )
+
+    # Profiling results if the scan was profiled
+    if profiler is not None:
+        profile_name = "profile_" + strftime("%Y-%m-%d_%H%M") + ".collapsed"
+        profiler.write_collapsed(profile_name)
+        print(Fore.CYAN + "\nProfile: " + str(profiler.sample_count) + " samples saved to " + profile_name +
+            "\n   Hottest functions (own samples, % of samples):" + Fore.WHITE
+        )
+        for function, count in profiler.top_functions(profile_top):
+            print("   " + str(count).rjust(8) + "  " + str(round(100.0 * count / profiler.sample_count, 1)).rjust(5) + "%  " + function)
+
+
+def watch():
+    # Check devices as they are added to devices.txt
+    global device_list, results, budget_deadline, current_job
+    collect_credentials()
+    load_profiles()
+    load_state()
+    # Canary tags are read from devices.txt
+    load_devices()
+    canary_check()
+    open_jsonl()
+    budget_deadline = None
+
+    # Latest result of each device for each credential set
+    watch_results = {}
+    known = set()
+    watcher = InventoryWatcher(inventory_file)
+    print(Fore.MAGENTA + "\n\nWatching " + inventory_file + " for new devices (" + watcher.method + ")" + Fore.WHITE)
+    try:
+        while True:
+            try:
+                devices = load_devices()
+            except Exception as error:
+                # File may be part way through being saved
+                print(Fore.MAGENTA + "\n   Unable to read " + inventory_file + ": " + str(error) + Fore.WHITE)
+                watcher.wait()
+                continue
+
+            # Compare with the devices seen last time
+            current = set(devices)
+            added = [device for device in devices if device not in known]
+            removed = known - current
+            for device in removed:
+                watch_results.pop(device, None)
+                state['verified'].pop(device, None)
+            if removed:
+                print(Fore.MAGENTA + "\n   Retired " + str(len(removed)) + " removed devices." + Fore.WHITE)
+            if added:
+                print(Fore.MAGENTA + "\n   Checking " + str(len(added)) + " new devices." + Fore.WHITE)
+                device_list = added
+                results = ResultTable()
+                current_job = {'results': []}
+                run_credential_sets()
+                for record in current_job['results']:
+                    watch_results.setdefault(record['device'], {})[record['credential']] = record['result']
+                current_job = None
+                save_state()
+            known = current
+            if added or removed:
+                write_watch_results(watch_results)
+            watcher.wait()
+    except KeyboardInterrupt:
+        save_state()
+
+
+def write_watch_results(watch_results):
+    # Latest result of every device still in devices.txt
+    watch_log = open(watch_results_file, 'w')
+    watch_log.write("device,credential,authentication type\n")
+    for device in sorted(watch_results):
+        for credential, auth_type in sorted(watch_results[device].items()):
+            watch_log.write(device + "," + credential + "," + auth_type + "\n")
+    watch_log.close()
+
+
+# Used to wait for devices.txt to change
+# Uses inotify on the file's directory so saves that replace the file are
+# seen too, otherwise checks the file every watch_interval seconds
+class InventoryWatcher(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.signature = self.stat()
+        self.fd = None
+        self.method = "polling"
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+            # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+            directory = os.path.dirname(os.path.abspath(filename))
+            if fd >= 0 and libc.inotify_add_watch(fd, directory.encode(), 0x2 | 0x8 | 0x80 | 0x100 | 0x200) >= 0:
+                self.fd = fd
+                self.method = "inotify"
+        except (AttributeError, OSError, TypeError):
+            pass
+
+    def stat(self):
+        try:
+            info = os.stat(self.filename)
+            return info.st_mtime_ns, info.st_size
+        except OSError:
+            return None
+
+    def wait(self):
+        # Returns once the file has changed
+        while True:
+            if self.fd is not None:
+                readable = select.select([self.fd], [], [], watch_interval)[0]
+                if readable:
+                    try:
+                        os.read(self.fd, 65536)
+                    except BlockingIOError:
+                        pass
+                    # Let the editor finish saving
+                    time.sleep(0.2)
+            else:
+                time.sleep(watch_interval)
+            signature = self.stat()
+            if signature != self.signature:
+                self.signature = signature
+                return
+
+
+def daemon():
+    # Run as a local audit service
+    # Inventory, profiles and saved state are loaded once and kept warm
+    global inventory_devices, jobs, job_queue, job_condition, budget_deadline
+    load_profiles()
+    load_state()
+    inventory_devices = load_devices()
+    print(Fore.MAGENTA + "\n\nLoaded " + str(len(inventory_devices)) + " devices from " + inventory_file + Fore.WHITE)
+    budget_deadline = None
+    open_jsonl()
+
+    # Jobs by id and the queue of jobs waiting to run
+    jobs = {}
+    job_queue = []
+    job_condition = threading.Condition()
+    # http.server is only imported in daemon mode to keep startup fast
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    class DaemonHTTPHandler(DaemonRequestHandler, BaseHTTPRequestHandler):
+        pass
+    class UnixHTTPServer(UnixServerMixin, ThreadingHTTPServer):
+        pass
+
+    runner = threading.Thread(target=job_runner, name="job-runner")
+    runner.daemon = True
+    runner.start()
+
+    if daemon_socket != '':
+        # Remove a socket left behind by a previous run
+        if os.path.exists(daemon_socket):
+            os.remove(daemon_socket)
+        server = UnixHTTPServer(daemon_socket, DaemonHTTPHandler)
+        listening = daemon_socket
+    else:
+        server = ThreadingHTTPServer((daemon_address, daemon_port), DaemonHTTPHandler)
+        listening = "http://" + daemon_address + ":" + str(daemon_port)
+    print(Fore.MAGENTA + "\nListening for audit jobs on " + listening + Fore.WHITE)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    save_state()
+
+
+def submit_job(request):
+    # Queue an audit job from an API request
+    # {"credentials": [{"username": "", "password": "", "enable": ""}],
+    #  "devices": [...optional subset...], "priority": 0}
+    credentials = []
+    for cred_set in request['credentials']:
+        credentials.append([cred_set['username'], cred_set['password'], cred_set.get('enable') or cred_set['password']])
+    if not credentials or not all(isinstance(value, str) for cred_set in credentials for value in cred_set):
+        raise TypeError("credentials must be a list of username/password strings")
+    # A string would be checked one character at a time
+    devices = request.get('devices')
+    if devices is not None and (not isinstance(devices, list) or not devices or
+            not all(isinstance(device, str) for device in devices)):
+        raise TypeError("devices must be a list of device names")
+    with job_condition:
+        job = {
+            'id': len(jobs) + 1,
+            'state': 'queued',
+            'priority': int(request.get('priority', 0)),
+            'devices': devices,
+            'credentials': credentials,
+            'submitted': time.time(),
+            'started': None,
+            'finished': None,
+            'results': [],
+            'summary': None,
+            'canary_failed': [],
+            'error': "",
+        }
+        jobs[job['id']] = job
+        # Highest priority first, then oldest first
+        heapq.heappush(job_queue, (-job['priority'], job['id']))
+        job_condition.notify()
+    return job
+
+
+def job_runner():
+    # Run queued jobs one at a time against the shared backends
+    global current_job, usernames, device_list, results
+    while True:
+        with job_condition:
+            while not job_queue:
+                job_condition.wait()
+            job = jobs[heapq.heappop(job_queue)[1]]
+        job['state'] = 'running'
+        job['started'] = time.time()
+        current_job = job
+        try:
+            usernames = job['credentials']
+            device_list = job['devices'] or inventory_devices
+            results = ResultTable()
+            canary_check()
+            job['canary_failed'] = [usernames[index][0] for index in sorted(canary_failed)]
+            run_credential_sets()
+            job['summary'] = results.stats(len(usernames))
+            job['state'] = 'done'
+            save_state()
+        except Exception as error:
+            job['state'] = 'failed'
+            job['error'] = type(error).__name__ + ": " + str(error)
+        finally:
+            current_job = None
+            job['finished'] = time.time()
+
+
+def job_status(job, with_results=False):
+    # Job details returned by the API, never including credentials
+    status = {
+        'id': job['id'],
+        'state': job['state'],
+        'priority': job['priority'],
+        'credentials': [cred_set[0] for cred_set in job['credentials']],
+        'devices': len(job['devices'] or inventory_devices),
+        'checked': len(job['results']),
+        'submitted': job['submitted'],
+        'started': job['started'],
+        'finished': job['finished'],
+        'canary_failed': job['canary_failed'],
+        'error': job['error'],
+    }
+    if with_results:
+        status['summary'] = job['summary']
+        status['results'] = job['results']
+    return status
+
+
+# Used to answer audit API requests
+#   GET  /status         inventory size and queued jobs
+#   GET  /jobs           all jobs
+#   POST /jobs           submit a job, returns its id
+#   GET  /jobs/<id>      job status, summary and results
+#   POST /inventory      reload devices.txt
+# Combined with http.server's BaseHTTPRequestHandler in daemon()
+class DaemonRequestHandler(object):
+    def do_GET(self):
+        if self.path == '/status':
+            self.reply(200, {'devices': len(inventory_devices), 'queued': len(job_queue),
+                'running': current_job['id'] if current_job is not None else None})
+        elif self.path == '/jobs':
+            self.reply(200, [job_status(job) for job in list(jobs.values())])
+        elif self.path.startswith('/jobs/'):
+            job_id = self.path[len('/jobs/'):]
+            job = None
+            if job_id.isdigit():
+                job = jobs.get(int(job_id))
+            if job is None:
+                self.reply(404, {'error': "No such job"})
+            else:
+                self.reply(200, job_status(job, with_results=True))
+        else:
+            self.reply(404, {'error': "Unknown path"})
+
+    def do_POST(self):
+        global inventory_devices
+        if self.path == '/jobs':
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                job = submit_job(json.loads(self.rfile.read(length)))
+            except (ValueError, KeyError, TypeError) as error:
+                self.reply(400, {'error': "Bad job request: " + str(error)})
+                return
+            self.reply(202, {'id': job['id']})
+        elif self.path == '/inventory':
+            # Applies to jobs started after the reload
+            inventory_devices = load_devices()
+            self.reply(200, {'devices': len(inventory_devices)})
+        else:
+            self.reply(404, {'error': "Unknown path"})
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Requests aren't logged to the screen
+        pass
+
+
+# Used to serve the audit API on a Unix socket
+# Combined with http.server's ThreadingHTTPServer in daemon()
+class UnixServerMixin(object):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        self.socket.bind(self.server_address)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def get_request(self):
+        request, client_address = self.socket.accept()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ("local", 0)
+
+
+def site_key(device):
+    # Returns the site a device is grouped under for scheduling
+    tags = device_info.get(device, {})
+    if 'site' in tags:
+        return tags['site']
+    try:
+        # Group IP addresses by subnet
+        return str(IPNetwork(device + "/" + str(site_prefix_len)).cidr)
+    except Exception:
+        # Group hostnames by domain
+        return device.partition(".")[2] or device
+
+
+# Used to spread connections across sites
+# Devices are queued per site and started round-robin across sites, limited
+# to maxthreads overall and, once sites are configured, site_maxthreads (or
+# site_limits) per site. Availability pings don't touch a site's AAA and
+# pass limit_sites=False
+class SiteScheduler(object):
+    def __init__(self, devices, monitor=None, planner=None, order=None, breaker=None, limit_sites=True):
+        self.monitor = monitor
+        self.planner = planner
+        self.breaker = breaker
+        # Devices left unchecked when the time budget ran out or the
+        # circuit breaker tripped
+        self.skipped = []
+        self.queues = {}
+        self.sites = []
+        # Devices are queued in list order unless an order of indexes is given
+        if order is None:
+            order = range(len(devices))
+        for device_count in order:
+            device = devices[device_count]
+            site = site_key(device)
+            if site not in self.queues:
+                self.queues[site] = deque()
+                self.sites.append(site)
+            self.queues[site].append((device, device_count))
+        # Checks in progress per site, worker threads running and checks
+        # not yet finished (some finish on the Telnet loop without a thread)
+        self.active = dict((site, 0) for site in self.sites)
+        # Untagged subnets and domains aren't capped unless site_limits is set
+        self.limit_sites = limit_sites and (bool(site_limits) or any('site' in device_info.get(device, {}) for device in devices))
+        self.total_active = 0
+        self.in_flight = 0
+        self.position = 0
+        self.condition = threading.Condition()
+
+    def next_device(self):
+        # Find the next site with waiting devices and a free slot
+        for offset in range(len(self.sites)):
+            index = (self.position + offset) % len(self.sites)
+            site = self.sites[index]
+            if not self.limit_sites or self.active[site] < site_limits.get(site, site_maxthreads):
+                self.position = index + 1
+                return site, self.queues[site].popleft()
+        return None, None
+
+    def run(self, target, asynchronous=False):
+        # An asynchronous target is called as target(device, device_count,
+        # done) and calls done() once the device is finished, possibly after
+        # returning; its site slot is held until then but not its thread
+        threads = []
+        while True:
+            with self.condition:
+                # Drop sites that have nothing left to start
+                self.sites = [site for site in self.sites if self.queues[site]]
+                if not self.sites:
+                    break
+                # Stop starting devices once the time budget is used up or
+                # the credential set has been stopped
+                if (self.planner is not None and self.planner.expired()) or (
+                        self.breaker is not None and self.breaker.tripped):
+                    for site in self.sites:
+                        self.skipped.extend(self.queues[site])
+                        self.queues[site].clear()
+                    continue
+                # Wait for a free thread and a site with a free slot
+                site = None
+                limit = maxthreads
+                if self.planner is not None:
+                    limit = self.planner.limit
+                if self.total_active < limit and self.in_flight - self.total_active < telnet_maxsessions:
+                    site, item = self.next_device()
+                if site is None:
+                    if self.planner is not None:
+                        self.condition.wait(max(0, self.planner.deadline - time.time()))
+                    else:
+                        self.condition.wait()
+                    continue
+                device, device_count = item
+                self.active[site] += 1
+                self.total_active += 1
+                self.in_flight += 1
+            # Start thread
+            my_thread = threading.Thread(target=self.worker, args=(target, site, device, device_count, asynchronous), name="worker-" + str(device_count))
+            my_thread.start()
+            threads.append(my_thread)
+
+            # Space out new connections while the AAA servers are overloaded
+            if self.monitor is not None and self.monitor.saturated():
+                time.sleep(aaa_throttle_delay)
 
-# Used to redirect standard output and/or error messages
-# This will redirect connection refused and reset error msgs to null
-devnull = open(os.devnull, 'w')
-class RedirectStdStreams(object):
-    def __init__(self, stdout=None, stderr=None):
-        self._stdout = stdout or sys.stdout
-        self._stderr = stderr or sys.stderr
+        # Joining will ensure all threads complete before continuing
+        for t in threads:
+            t.join()
+        # Then wait for checks still finishing on the Telnet loop
+        with self.condition:
+            while self.in_flight > 0:
+                self.condition.wait()
+
+    def worker(self, target, site, device, device_count, asynchronous):
+        started = time.time()
+        finished = []
+        def done():
+            if finished:
+                return
+            finished.append(True)
+            # Release the device's site slot
+            with self.condition:
+                self.active[site] -= 1
+                self.in_flight -= 1
+                if self.planner is not None:
+                    waiting = sum(len(self.queues[site]) for site in self.sites)
+                    self.planner.observe(time.time() - started, waiting)
+                self.condition.notify_all()
+        try:
+            if asynchronous:
+                target(device, device_count, done)
+            else:
+                target(device, device_count)
+                done()
+        except Exception:
+            done()
+            raise
+        finally:
+            # Release thread to pool
+            with self.condition:
+                self.total_active -= 1
+                self.condition.notify_all()
+
+
+def prioritize(devices):
+    # Order device indexes for a time budgeted scan: high priority first,
+    # then devices never verified, then those verified longest ago
+    ranks = {'high': 0, 'normal': 1, 'low': 2}
+    def rank(device_count):
+        device = devices[device_count]
+        priority = ranks.get(device_info.get(device, {}).get('priority', 'normal'), 1)
+        return priority, state['verified'].get(device, 0)
+    return sorted(range(len(devices)), key=rank)
+
+
+# Used to fit a scan into its time budget
+# Sizes the thread count, and if needed the timeouts, from the average time
+# of the checks seen so far and the number of devices still waiting
+class BudgetPlanner(object):
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.limit = maxthreads
+        self.durations = deque(maxlen=200)
+        self.base_timeouts = (connect_timeout, telnet_timeout)
+
+    def expired(self):
+        return time.time() >= self.deadline
+
+    def observe(self, duration, waiting):
+        global connect_timeout, telnet_timeout
+        self.durations.append(duration)
+        if len(self.durations) < budget_samples:
+            return
+        time_left = self.deadline - time.time()
+        if time_left <= 0:
+            return
+        average = sum(self.durations) / len(self.durations)
+        # Threads needed to get through the waiting devices in time
+        needed = int(waiting * average / time_left) + 1
+        self.limit = min(budget_maxthreads, max(maxthreads, needed))
+        # Shorten timeouts if even the most threads won't be enough
+        scale = min(1.0, float(budget_maxthreads) / needed)
+        connect_timeout = max(budget_min_timeout, self.base_timeouts[0] * scale)
+        telnet_timeout = max(budget_min_timeout, self.base_timeouts[1] * scale)
+
+    def restore_timeouts(self):
+        global connect_timeout, telnet_timeout
+        connect_timeout, telnet_timeout = self.base_timeouts
+
+
+def load_state():
+    # Load information saved by previous runs
+    global state
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as fn:
+            state = json.load(fn)
+    state.setdefault('verified', {})
+    state.setdefault('host_keys', {})
+    state.setdefault('profiles', {})
+    state.setdefault('timeouts', {})
+
+
+def save_state():
+    # Save information for the next run
+    with open(state_file, 'w') as fn:
+        json.dump(state, fn)
+
+
+def load_backend(name):
+    # Returns the module for a protocol backend, importing it on first use
+    backend = backends.get(name)
+    if backend is None:
+        # Only one thread imports, the rest wait for it
+        with backend_lock:
+            if name not in backends:
+                backends[name] = importlib.import_module(backend_modules[name])
+                if name == 'ssh':
+                    quiet_ssh_logging()
+            backend = backends[name]
+    return backend
+
+
+def quiet_ssh_logging():
+    # Used to filter connection refused and reset error msgs
+    # paramiko and netmiko report them through logging, which would otherwise
+    # print them to stderr. Handling them at the logger keeps sys.stderr
+    # untouched for every other thread
+    if ssh_log_file != '':
+        handler = logging.FileHandler(ssh_log_file)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(threadName)s %(name)s %(message)s"))
+    else:
+        handler = logging.NullHandler()
+    for name in ('paramiko', 'netmiko'):
+        logger = logging.getLogger(name)
+        logger.addHandler(handler)
+        logger.propagate = False
+
+
+def get_telnet_loop():
+    # Returns the shared Telnet loop, starting it on first use
+    global telnet_loop
+    with backend_lock:
+        if telnet_loop is None:
+            telnet_loop = TelnetLoop()
+    return telnet_loop
+
+
+def get_jump_pool():
+    # Returns the shared jump host connections, creating them on first use
+    global jump_pool
+    with backend_lock:
+        if jump_pool is None:
+            jump_pool = JumpHostPool()
+    return jump_pool
+
+
+def load_profiles():
+    # Load vendor prompt profiles and compile them into prompt matchers
+    global profiles, combined_matcher
+    profiles = builtin_profiles
+    if os.path.exists(profile_file):
+        with open(profile_file, 'r') as fn:
+            profiles = json.load(fn)
+        print(Fore.MAGENTA + "\n\nLoaded " + str(len(profiles)) + " device profiles from " + profile_file + Fore.WHITE)
+    for name in profiles:
+        profiles[name]['matcher'] = compile_prompts({name: profiles[name]})
+        # Patterns that identify the profile from SSH and Telnet banners
+        for key in ('ssh_banner', 'telnet_banner'):
+            if profiles[name].get(key):
+                profiles[name][key + '_regex'] = re.compile(profiles[name][key])
+    combined_matcher = compile_prompts(profiles)
+
+
+def compile_prompts(profile_set):
+    # Combine the login, success and failure prompts of the given profiles
+    # into one regex. Each prompt gets a named group so a match tells which
+    # profile and prompt it was
+    alternatives = []
+    groups = {}
+    for profile_index, name in enumerate(sorted(profile_set)):
+        profile = profile_set[name]
+        prompts = []
+        for pattern, send in profile.get('login', []):
+            prompts.append({'kind': 'login', 'pattern': pattern, 'send': send})
+        prompts.append({'kind': 'success', 'pattern': profile['success'], 'send': None})
+        if profile.get('failure'):
+            prompts.append({'kind': 'failure', 'pattern': profile['failure'], 'send': None})
+        for prompt_index, prompt in enumerate(prompts):
+            group = "p" + str(profile_index) + "_" + str(prompt_index)
+            prompt['profile'] = name
+            prompt['enable'] = profile.get('enable', True)
+            groups[group] = prompt
+            alternatives.append("(?P<" + group + ">" + prompt['pattern'] + ")")
+    regex = re.compile("|".join(alternatives).encode('ascii'))
+    return {'regex': regex, 'groups': groups}
+
+
+# Used to detect overloaded AAA servers
+# Keeps a rolling window of authentication latency and results
+class AaaMonitor(object):
+    def __init__(self):
+        self.samples = deque(maxlen=aaa_window)
+        self.lock = threading.Lock()
+        self.overloaded = False
+
+    def record(self, latency, status):
+        with self.lock:
+            self.samples.append((latency, status))
+            overloaded = self.check()
+            changed = overloaded != self.overloaded
+            self.overloaded = overloaded
+        # Let the user know when throttling starts and stops
+        if changed:
+            if overloaded:
+                user_message = "\n   AAA servers appear overloaded, slowing down connections."
+            else:
+                user_message = "\n   AAA servers recovered, resuming full speed."
+            screenlock.acquire()
+            print(Fore.YELLOW + user_message + Fore.WHITE)
+            screenlock.release()
+
+    def check(self):
+        if len(self.samples) < aaa_min_samples:
+            return False
+        average = sum(sample[0] for sample in self.samples) / len(self.samples)
+        timeouts = sum(1 for sample in self.samples if sample[1] == "timeout")
+        return average > aaa_latency_limit or timeouts > aaa_timeout_limit * len(self.samples)
+
+    def saturated(self):
+        return self.overloaded
+
+
+# Used to stop a credential set that devices keep rejecting
+# Only definite answers count: a login accepted or rejected by a device
+# that was reached. Trips after breaker_consecutive rejections in a row or
+# when at least breaker_reject_rate of the last breaker_window answers were
+# rejections
+class CircuitBreaker(object):
+    def __init__(self):
+        self.answers = deque(maxlen=breaker_window)
+        self.consecutive = 0
+        self.lock = threading.Lock()
+        self.tripped = False
+        self.reason = ""
+
+    def record(self, outcome):
+        if outcome not in ("success", "auth_rejected"):
+            return
+        with self.lock:
+            rejected = outcome == "auth_rejected"
+            self.answers.append(rejected)
+            if rejected:
+                self.consecutive += 1
+            else:
+                self.consecutive = 0
+            if self.tripped:
+                return
+            if breaker_consecutive > 0 and self.consecutive >= breaker_consecutive:
+                self.reason = str(self.consecutive) + " rejections in a row"
+            elif (breaker_reject_rate > 0 and len(self.answers) == breaker_window and
+                    sum(self.answers) >= breaker_reject_rate * breaker_window):
+                self.reason = str(sum(self.answers)) + " of the last " + str(breaker_window) + " logins rejected"
+            else:
+                return
+            self.tripped = True
+        screenlock.acquire()
+        print(Fore.YELLOW + "\n   Credentials rejected repeatedly (" + self.reason + "), stopping this credential set." + Fore.WHITE)
+        screenlock.release()
+
+
+# Raised when the jump host itself can't be used
+class JumpHostError(Exception):
+    pass
+
+
+# Used to share jump host connections between checks
+# Opens up to jump_connections connections to the jump host as they are
+# needed and hands out direct-tcpip channels over the least busy one, at
+# most jump_channels per connection. New connections are made outside the
+# lock so releases and other channels aren't held up by the login
+class JumpHostPool(object):
+    def __init__(self):
+        self.connections = []
+        # Connections being opened, counted against jump_connections
+        self.connecting = 0
+        self.condition = threading.Condition()
+
+    def connect(self):
+        paramiko = load_backend('jump')
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.RejectPolicy())
+        try:
+            client.connect(jump_host, port=jump_port,
+                username=jump_username or username,
+                password=jump_password or None,
+                key_filename=jump_key_file or None,
+                timeout=connect_timeout)
+        except Exception as error:
+            raise JumpHostError("Unable to connect to jump host " + jump_host + ": " + str(error))
+        transport = client.get_transport()
+        transport.set_keepalive(30)
+        return {'client': client, 'transport': transport, 'channels': 0}
+
+    def open_channel(self, address, port):
+        with self.condition:
+            while True:
+                # Drop connections the jump host has closed
+                self.connections = [connection for connection in self.connections
+                    if connection['transport'].is_active() or connection['channels'] > 0]
+                available = [connection for connection in self.connections
+                    if connection['transport'].is_active() and connection['channels'] < jump_channels]
+                if available:
+                    connection = min(available, key=lambda connection: connection['channels'])
+                    connection['channels'] += 1
+                    break
+                if len(self.connections) + self.connecting < jump_connections:
+                    # Reserve the connection, then log in without the lock
+                    self.connecting += 1
+                    connection = None
+                    break
+                # Wait for a channel to be released or a connection to open
+                self.condition.wait()
+        if connection is None:
+            try:
+                connection = self.connect()
+            finally:
+                with self.condition:
+                    self.connecting -= 1
+                    if connection is not None:
+                        connection['channels'] += 1
+                        self.connections.append(connection)
+                    self.condition.notify_all()
+        try:
+            return connection['transport'].open_channel('direct-tcpip', (address, port), ('127.0.0.1', 0), timeout=connect_timeout)
+        except Exception:
+            self.release(None, connection)
+            raise
+
+    def release(self, channel, connection=None):
+        if channel is not None:
+            channel.close()
+        with self.condition:
+            if channel is not None:
+                transport = channel.get_transport()
+                connection = next((connection for connection in self.connections if connection['transport'] is transport), None)
+            if connection is not None:
+                connection['channels'] -= 1
+            self.condition.notify()
+
+
+# Outcome and transport codes stored in ResultTable
+OUTCOMES = ['success', 'auth_rejected', 'retry', 'refused', 'unreachable', 'timeout', 'dns_failure', 'protocol_error', 'not_checked', 'jump_failed', 'duplicate', 'stopped']
+TRANSPORTS = ['', 'ssh', 'telnet']
+# Outcomes of devices that were never checked, left out of check times
+UNCHECKED = [OUTCOMES.index(outcome) for outcome in ('not_checked', 'duplicate', 'stopped')]
+
+
+# Used to hold results for large runs
+# One typed array per column instead of a string or dict per result, so a
+# 100k device run with several credential sets stays a few MB
+class ResultTable(object):
+    def __init__(self):
+        self.devices = array('I')
+        self.credentials = array('H')
+        self.outcomes = array('B')
+        self.transports = array('B')
+        self.latencies = array('f')
+        self.lock = threading.Lock()
+
+    def add(self, device_index, credential_index, outcome, transport, latency):
+        with self.lock:
+            self.devices.append(device_index)
+            self.credentials.append(credential_index)
+            self.outcomes.append(OUTCOMES.index(outcome))
+            self.transports.append(TRANSPORTS.index(transport))
+            self.latencies.append(latency)
+
+    def stats(self, credential_count):
+        # Outcome counts and latency percentiles for each credential set
+        counts = [[0] * len(OUTCOMES) for credential in range(credential_count)]
+        latencies = [array('f') for credential in range(credential_count)]
+        for credential, outcome, latency in zip(self.credentials, self.outcomes, self.latencies):
+            counts[credential][outcome] += 1
+            if outcome not in UNCHECKED:
+                latencies[credential].append(latency)
+        stats = []
+        for credential in range(credential_count):
+            ordered = sorted(latencies[credential])
+            percentiles = {}
+            for percent in (50, 90, 99):
+                if ordered:
+                    percentiles[percent] = ordered[min(len(ordered) - 1, len(ordered) * percent // 100)]
+                else:
+                    percentiles[percent] = 0.0
+            stats.append({
+                'total': sum(counts[credential]),
+                'checked': len(ordered),
+                'counts': dict(zip(OUTCOMES, counts[credential])),
+                'percentiles': percentiles,
+            })
+        return stats
+
+
+# Used to split a credential set's log by site, subnet or outcome
+# Each partition has its own buffered file, opened when its first result
+# arrives; at most partition_max_open stay open. An index of device to
+# partition is written alongside. Files from the same minute are appended
+# to; gzip files get a new member
+class PartitionWriter(object):
+    def __init__(self, prefix, header):
+        self.prefix = prefix
+        self.header = header
+        self.files = OrderedDict()
+        self.filenames = set()
+        self.index = []
+
+    def partition(self, check):
+        values = []
+        for key in partition_by:
+            if key == 'site':
+                values.append(site_key(check['device']))
+            elif key == 'subnet':
+                try:
+                    values.append(str(IPNetwork(check['address'] + "/" + str(partition_prefix_len)).cidr))
+                except Exception:
+                    values.append("unresolved")
+            else:
+                values.append(outcome_class(check))
+        # Keep names safe to use in file names
+        return "_".join(re.sub(r"[^A-Za-z0-9.-]+", "-", value) for value in values)
+
+    def write(self, check, row):
+        # Called with screenlock held
+        name = self.partition(check)
+        if name in self.files:
+            self.files.move_to_end(name)
+        else:
+            while len(self.files) >= max(1, partition_max_open):
+                self.files.popitem(last=False)[1].close()
+            filename = self.prefix + "_" + name + ".csv"
+            new = not os.path.exists(filename) and not os.path.exists(filename + ".gz")
+            self.files[name] = open(filename, 'a', buffering=65536)
+            self.filenames.add(filename)
+            if new:
+                self.files[name].write(self.header)
+        self.files[name].write(row)
+        self.index.append(check['device'] + "," + name + "\n")
+
+    def close(self):
+        index_name = self.prefix + "_index.csv"
+        new = not os.path.exists(index_name)
+        index_file = open(index_name, 'a')
+        if new:
+            index_file.write("device,partition\n")
+        index_file.writelines(self.index)
+        index_file.close()
+        for partition_file in self.files.values():
+            partition_file.close()
+        if partition_gzip:
+            for filename in sorted(self.filenames):
+                with open(filename, 'rb') as plain, gzip.open(filename + ".gz", 'ab') as packed:
+                    shutil.copyfileobj(plain, packed)
+                os.remove(filename)
+        self.files = OrderedDict()
+        self.filenames = set()
+        self.index = []
+
+
+# Used to profile scans
+# Samples the stack of every thread each interval. Stacks are grouped by
+# thread role (worker, telnet-loop, MainThread) rather than by thread so
+# thousands of short-lived workers fold into one flame graph
+class SamplingProfiler(object):
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = {}
+        self.own = {}
+        self.sample_count = 0
+        self.running = False
+        self.thread = threading.Thread(target=self.run, name="profiler")
+        self.thread.daemon = True
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while self.running:
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                # Thread role without the worker number
+                role = names.get(thread_id, "thread").split("-")[0]
+                functions = []
+                while frame is not None:
+                    code = frame.f_code
+                    functions.append(code.co_name + " (" + os.path.basename(code.co_filename) + ":" + str(code.co_firstlineno) + ")")
+                    frame = frame.f_back
+                stack = role + ";" + ";".join(reversed(functions))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.own[functions[0]] = self.own.get(functions[0], 0) + 1
+                self.sample_count += 1
+            time.sleep(self.interval)
+
+    def write_collapsed(self, filename):
+        # One line per stack, frames separated by ; followed by the count
+        profile_log = open(filename, 'w')
+        for stack, count in sorted(self.stacks.items()):
+            profile_log.write(stack + " " + str(count) + "\n")
+        profile_log.close()
+
+    def top_functions(self, count):
+        return sorted(self.own.items(), key=lambda item: item[1], reverse=True)[:count]
+
+
+# Telnet commands used for option negotiation
+IAC = 255
+DONT = 254
+DO = 253
+WONT = 252
+WILL = 251
+SB = 250
+SE = 240
+
+
+# A single Telnet connection driven by TelnetLoop
+# steps is a generator yielding (data to send, prompt regex, timeout) and
+# receiving (match, text) back, with match None if the prompt timed out
+class TelnetSession(object):
+    def __init__(self, address, port, steps, record=False, timeout=None, callback=None):
+        self.address = address
+        self.port = port
+        self.steps = steps
+        # Called with the session once it has finished
+        self.callback = callback
+        self.connect_timeout = timeout or connect_timeout
+        # Raw bytes sent and received with their time, if recording
+        self.transcript = None
+        if record:
+            self.transcript = []
+        self.sock = None
+        self.connected = False
+        self.closed = False
+        # Raw bytes holding an incomplete telnet command
+        self.rawbuf = b""
+        # Received data with telnet commands removed
+        self.buffer = b""
+        self.outbuf = b""
+        self.regex = None
+        self.deadline = None
+        self.started = None
+        self.connect_time = None
+        self.error = None
+        self.done = threading.Event()
+
+    def feed(self, data):
+        # Remove telnet commands from received data, refusing every option
+        data = self.rawbuf + data
+        cooked = bytearray()
+        i = 0
+        while i < len(data):
+            if data[i] != IAC:
+                cooked.append(data[i])
+                i += 1
+                continue
+            if i + 1 >= len(data):
+                break
+            command = data[i + 1]
+            if command == IAC:
+                cooked.append(IAC)
+                i += 2
+            elif command in (DO, DONT, WILL, WONT):
+                if i + 2 >= len(data):
+                    break
+                if command == DO:
+                    self.outbuf += bytes([IAC, WONT, data[i + 2]])
+                elif command == WILL:
+                    self.outbuf += bytes([IAC, DONT, data[i + 2]])
+                i += 3
+            elif command == SB:
+                end = data.find(bytes([IAC, SE]), i + 2)
+                if end < 0:
+                    break
+                i = end + 2
+            else:
+                i += 2
+        self.rawbuf = data[i:]
+        self.buffer += bytes(cooked)
+
+    def write(self, data):
+        self.outbuf += data.replace(bytes([IAC]), bytes([IAC, IAC]))
+
+    def record(self, direction, data):
+        if self.transcript is not None:
+            self.transcript.append((round(time.time() - self.started, 4), direction, data))
+
+
+# Used to run many telnet sessions from one thread
+# Worker threads submit sessions and wait on session.done while this loop
+# connects, reads, matches prompts and handles timeouts for all of them
+class TelnetLoop(object):
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.sessions = set()
+        self.pending = deque()
+        self.lock = threading.Lock()
+        # Wakes the loop when a new session is submitted
+        self.wake_recv, self.wake_send = socket.socketpair()
+        self.wake_recv.setblocking(False)
+        self.selector.register(self.wake_recv, selectors.EVENT_READ, None)
+        self.thread = threading.Thread(target=self.run, name="telnet-loop")
+        self.thread.daemon = True
+        self.thread.start()
+        # Finished sessions' callbacks (reporting, log writes) run on their
+        # own thread so they never hold up the loop
+        self.finished = queue.Queue()
+        self.callback_thread = threading.Thread(target=self.run_callbacks, name="telnet-done")
+        self.callback_thread.daemon = True
+        self.callback_thread.start()
+
+    def submit(self, address, port, steps, record=False, timeout=None, callback=None):
+        session = TelnetSession(address, port, steps, record, timeout, callback)
+        with self.lock:
+            self.pending.append(session)
+        self.wake_send.send(b"\0")
+        return session
+
+    def run(self):
+        while True:
+            # Wait for socket activity or the next timeout
+            deadlines = [session.deadline for session in self.sessions if session.deadline is not None]
+            timeout = None
+            if deadlines:
+                timeout = max(0, min(deadlines) - time.time())
+            for key, events in self.selector.select(timeout):
+                if key.data is None:
+                    self.start_pending()
+                else:
+                    self.handle(key.data, events)
+            self.expire()
+
+    def run_callbacks(self):
+        while True:
+            session = self.finished.get()
+            try:
+                session.callback(session)
+            except Exception as error:
+                print(Fore.YELLOW + "\n   Error finishing Telnet check of " + session.address + ": " +
+                    type(error).__name__ + ": " + str(error) + Fore.WHITE)
+
+    def start_pending(self):
+        try:
+            self.wake_recv.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            pass
+        with self.lock:
+            sessions = list(self.pending)
+            self.pending.clear()
+        for session in sessions:
+            self.connect(session)
+
+    def connect(self, session):
+        # Start a non-blocking connection
+        session.started = time.time()
+        session.deadline = session.started + session.connect_timeout
+        try:
+            family = socket.AF_INET6 if ":" in session.address else socket.AF_INET
+            session.sock = socket.socket(family, socket.SOCK_STREAM)
+            session.sock.setblocking(False)
+            result = session.sock.connect_ex((session.address, session.port))
+        except Exception as error:
+            self.finish(session, error)
+            return
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', None)):
+            self.finish(session, OSError(result, os.strerror(result)))
+            return
+        self.sessions.add(session)
+        self.selector.register(session.sock, selectors.EVENT_WRITE, session)
+
+    def handle(self, session, events):
+        if not session.connected:
+            # Connection finished, check whether it succeeded
+            result = session.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if result != 0:
+                self.finish(session, OSError(result, os.strerror(result)))
+                return
+            session.connected = True
+            session.connect_time = time.time() - session.started
+            session.deadline = None
+            self.resume(session, None)
+        else:
+            if events & selectors.EVENT_READ:
+                try:
+                    data = session.sock.recv(4096)
+                except (BlockingIOError, InterruptedError):
+                    data = None
+                except OSError as error:
+                    self.finish(session, error)
+                    return
+                if data == b"":
+                    session.closed = True
+                elif data:
+                    session.record("recv", data)
+                    session.feed(data)
+        self.match(session)
+        self.update(session)
+
+    def send(self, session):
+        try:
+            sent = session.sock.send(session.outbuf)
+            session.record("send", session.outbuf[:sent])
+            session.outbuf = session.outbuf[sent:]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as error:
+            self.finish(session, error)
+
+    def match(self, session):
+        # Hand matched prompts back to the session steps
+        while session.regex is not None:
+            match = session.regex.search(session.buffer)
+            if match is not None:
+                text = session.buffer[:match.end()]
+                session.buffer = session.buffer[match.end():]
+                self.resume(session, (match, text))
+            elif session.closed:
+                # Nothing more will arrive, same as a timeout
+                text = session.buffer
+                session.buffer = b""
+                self.resume(session, (None, text))
+            else:
+                break
+
+    def resume(self, session, value):
+        # Run the session steps until they wait for the next prompt
+        try:
+            if value is None:
+                step = next(session.steps)
+            else:
+                step = session.steps.send(value)
+        except StopIteration:
+            self.finish(session, None)
+            return
+        except Exception as error:
+            self.finish(session, error)
+            return
+        data, session.regex, timeout = step
+        if data:
+            session.write(data)
+        session.deadline = time.time() + timeout
+
+    def update(self, session):
+        # Send anything queued and wait for more data
+        if session.done.is_set():
+            return
+        if session.outbuf:
+            self.send(session)
+        if session.done.is_set():
+            return
+        events = selectors.EVENT_READ
+        if session.outbuf:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(session.sock, events, session)
+
+    def expire(self):
+        now = time.time()
+        for session in list(self.sessions):
+            if session.deadline is None or session.deadline > now:
+                continue
+            if not session.connected:
+                self.finish(session, socket.timeout("timed out"))
+                continue
+            # Prompt not seen in time, hand back whatever arrived
+            text = session.buffer
+            session.buffer = b""
+            self.resume(session, (None, text))
+            self.match(session)
+            self.update(session)
+
+    def finish(self, session, error):
+        session.regex = None
+        session.deadline = None
+        session.error = error
+        if session in self.sessions:
+            self.sessions.discard(session)
+            self.selector.unregister(session.sock)
+        if session.sock is not None:
+            session.sock.close()
+        session.done.set()
+        if session.callback is not None:
+            self.finished.put(session)
+
+
+# Used to replay a recorded Telnet session to clients
+# Device output is sent with the recorded delays (scaled by replay_speed).
+# Where the recorded client sent a line (username, password, command) the
+# replay waits for the client to send one; other sends (option replies)
+# aren't waited for
+class ReplayHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.settimeout(replay_timeout)
+        pending = b""
+        previous = 0
+        try:
+            for offset, direction, data in self.server.transcript['events']:
+                if direction == "recv":
+                    if replay_speed > 0:
+                        time.sleep(max(0, offset - previous) * replay_speed)
+                    self.request.sendall(data.encode('latin-1'))
+                else:
+                    # Wait for the client's lines
+                    for line in range(data.count("\n")):
+                        while b"\n" not in pending:
+                            received = self.request.recv(4096)
+                            if received == b"":
+                                return
+                            pending += received
+                        pending = pending[pending.index(b"\n") + 1:]
+                previous = offset
+        except OSError:
+            pass
 
-    def __enter__(self):
-        self.old_stdout, self.old_stderr = sys.stdout, sys.stderr
-        self.old_stdout.flush(); self.old_stderr.flush()
-        sys.stdout, sys.stderr = self._stdout, self._stderr
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        self._stdout.flush(); self._stderr.flush()
-        sys.stdout = self.old_stdout
-        sys.stderr = self.old_stderr
+class ReplayServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
 
 
 # Used for wait messages during availability check
 avail_complete = ''
+avail_scan_time = ''
 message_count = 0
 def wait_message():
     global message_count
@@ -0,0 +1,38 @@
+# Startup must stay fast for availability-only and Telnet-only runs, so the
+# SSH backends are only imported when the first SSH check needs them
+import json
+import os
+import subprocess
+import sys
+
+# Seconds allowed for importing credential_check, netmiko alone takes longer
+import_budget = 0.5
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+probe = """
+import json, sys, time
+started = time.perf_counter()
+import credential_check
+elapsed = time.perf_counter() - started
+print(json.dumps({'elapsed': elapsed, 'modules': sorted(sys.modules)}))
+"""
+
+
+def import_credential_check():
+    # Import in a fresh interpreter so other tests' imports don't count
+    output = subprocess.run([sys.executable, "-c", probe], cwd=repo_dir,
+        capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def test_ssh_backends_not_imported():
+    modules = import_credential_check()['modules']
+    for name in ("netmiko", "paramiko"):
+        assert name not in modules
+
+
+def test_import_within_budget():
+    # Best of a few runs so a busy machine doesn't fail the test
+    elapsed = min(import_credential_check()['elapsed'] for attempt in range(3))
+    assert elapsed < import_budget, "import took %.3fs" % elapsed
@@ -0,0 +1,198 @@
+# Runs the netmiko and OpenSSH backends against a local SSH simulator and
+# compares their login times
+import importlib.util
+import os
+import re
+import shutil
+import socket
+import subprocess
+import threading
+import time
+
+import pytest
+
+import credential_check
+
+paramiko = pytest.importorskip("paramiko")
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+host_key = paramiko.RSAKey.generate(2048)
+
+# Logins timed per backend by the benchmark
+benchmark_logins = 20
+
+
+class SimulatorServer(paramiko.ServerInterface):
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.command = threading.Event()
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        if password == self.simulator.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        # Some devices refuse to run commands over exec
+        if not self.simulator.exec_allowed:
+            return False
+        self.command.set()
+        return True
+
+
+class Simulator(object):
+    # Cisco style SSH device: password login, then a rtr1# prompt
+    def __init__(self, password="good", exec_allowed=True):
+        self.password = password
+        self.exec_allowed = exec_allowed
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            try:
+                connection, address = self.listener.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self.session, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def session(self, connection):
+        transport = paramiko.Transport(connection)
+        transport.add_server_key(host_key)
+        server = SimulatorServer(self)
+        try:
+            transport.start_server(server=server)
+            channel = transport.accept(20)
+            if channel is None:
+                return
+            if server.command.wait(0.2):
+                channel.send_exit_status(0)
+                channel.close()
+                return
+            channel.send(b"\r\nrtr1#")
+            pending = b""
+            while True:
+                data = channel.recv(1024)
+                if not data:
+                    return
+                pending += data.replace(b"\r", b"\n")
+                while b"\n" in pending:
+                    line, pending = pending.split(b"\n", 1)
+                    channel.send(line + b"\r\nrtr1#")
+        except Exception:
+            pass
+        finally:
+            transport.close()
+
+    def close(self):
+        self.listener.close()
+
+
+def openssh_available():
+    # The OpenSSH backend needs SSH_ASKPASS_REQUIRE, added in OpenSSH 8.4
+    if shutil.which(credential_check.openssh_command) is None:
+        return False
+    version = subprocess.run([credential_check.openssh_command, "-V"], capture_output=True, text=True).stderr
+    match = re.search(r"OpenSSH_(\d+)\.(\d+)", version)
+    return match is not None and (int(match.group(1)), int(match.group(2))) >= (8, 4)
+
+
+needs_netmiko = pytest.mark.skipif(importlib.util.find_spec("netmiko") is None, reason="netmiko not installed")
+needs_openssh = pytest.mark.skipif(not openssh_available(), reason="OpenSSH 8.4 or later not installed")
+backends = [
+    pytest.param('netmiko', marks=needs_netmiko),
+    pytest.param('openssh', marks=needs_openssh),
+]
+
+
+@pytest.fixture
+def simulator():
+    servers = []
+    def start(**options):
+        server = Simulator(**options)
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture(autouse=True)
+def credentials(monkeypatch):
+    monkeypatch.setattr(credential_check, 'profile_file', os.path.join(repo_dir, "profiles.json"))
+    monkeypatch.setattr(credential_check, 'state', {'verified': {}, 'host_keys': {}, 'profiles': {}, 'timeouts': {}}, raising=False)
+    monkeypatch.setattr(credential_check, 'device_info', {}, raising=False)
+    monkeypatch.setattr(credential_check, 'aaa_monitor', credential_check.AaaMonitor(), raising=False)
+    monkeypatch.setattr(credential_check, 'usernames', [["admin", "good", "secret"]], raising=False)
+    credential_check.load_profiles()
+    credential_check.use_credentials(0)
+
+
+def ssh_check(backend, port):
+    credential_check.ssh_backend = backend
+    check = credential_check.new_check("127.0.0.1", 0)
+    check['address'] = "127.0.0.1"
+    check['ports']['ssh'] = port
+    check['profile'] = "cisco_ios"
+    try:
+        credential_check.ssh_check(check)
+    finally:
+        credential_check.ssh_backend = 'netmiko'
+    return check
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_login_accepted(backend, simulator):
+    server = simulator()
+    check = ssh_check(backend, server.port)
+    assert check['auth_type'] == "SSH"
+    assert check['host_key'] == credential_check.key_fingerprint(host_key.asbytes())
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_login_rejected(backend, simulator):
+    server = simulator(password="other")
+    check = ssh_check(backend, server.port)
+    assert check['auth_type'] == "Credentials incorrect but SSH open"
+    assert check['error'] == "auth_rejected"
+    assert check['host_key'] == credential_check.key_fingerprint(host_key.asbytes())
+
+
+@needs_openssh
+def test_openssh_exec_refused(simulator):
+    # ssh exits with 255 when the command is refused after logging in
+    server = simulator(exec_allowed=False)
+    check = ssh_check('openssh', server.port)
+    assert check['auth_type'] == "SSH"
+
+
+@needs_netmiko
+@needs_openssh
+def test_benchmark(simulator):
+    # Time the same logins through each backend, shown with pytest -s
+    server = simulator()
+    for backend in ('netmiko', 'openssh'):
+        started = time.time()
+        for login in range(benchmark_logins):
+            assert ssh_check(backend, server.port)['auth_type'] == "SSH"
+        elapsed = time.time() - started
+        print("%s: %d logins in %.2fs, %.0fms each" % (backend, benchmark_logins, elapsed, elapsed * 1000 / benchmark_logins))
@@ -0,0 +1,131 @@
+# Runs the built-in Telnet client against a local Telnet simulator
+import os
+import socketserver
+import threading
+import time
+
+import pytest
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+import credential_check
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class SimulatorHandler(socketserver.BaseRequestHandler):
+    # Cisco style login: Username, Password, then a prompt or a failure
+    def handle(self):
+        simulator = self.server
+        connection = self.request
+        connection.settimeout(10)
+        try:
+            if simulator.behaviour == 'silent':
+                connection.recv(100)
+                return
+            time.sleep(simulator.delay)
+            # Ask the client to suppress go-ahead, as many devices do
+            connection.sendall(b"\xff\xfb\x03User Access Verification\r\n\r\nUsername: ")
+            connection.recv(100)
+            connection.sendall(b"Password: ")
+            if connection.recv(100).strip() == simulator.password:
+                connection.sendall(b"\r\nrtr1>")
+            else:
+                connection.sendall(b"\r\n% Login invalid\r\n\r\nUsername: ")
+            connection.recv(100)
+        except OSError:
+            pass
+
+
+class Simulator(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 4096
+
+    def __init__(self, behaviour='login', delay=0, password=b"good"):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), SimulatorHandler)
+        self.behaviour = behaviour
+        self.delay = delay
+        self.password = password
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+@pytest.fixture
+def simulator():
+    servers = []
+    def start(**options):
+        server = Simulator(**options)
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def credentials(monkeypatch):
+    monkeypatch.setattr(credential_check, 'profile_file', os.path.join(repo_dir, "profiles.json"))
+    monkeypatch.setattr(credential_check, 'state', {'verified': {}, 'host_keys': {}, 'profiles': {}, 'timeouts': {}}, raising=False)
+    monkeypatch.setattr(credential_check, 'device_info', {}, raising=False)
+    monkeypatch.setattr(credential_check, 'aaa_monitor', credential_check.AaaMonitor(), raising=False)
+    monkeypatch.setattr(credential_check, 'usernames', [["admin", "good", "secret"]], raising=False)
+    credential_check.load_profiles()
+    credential_check.use_credentials(0)
+
+
+def telnet_checks(port, count):
+    # Start count Telnet checks from this thread and wait for all of them
+    checks = []
+    finished = threading.Semaphore(0)
+    for index in range(count):
+        check = credential_check.new_check("127.0.0.1", index)
+        check['address'] = "127.0.0.1"
+        check['ports']['telnet'] = port
+        check['profile'] = None
+        credential_check.telnet_check(check, finished.release)
+        checks.append(check)
+    for check in checks:
+        assert finished.acquire(timeout=30)
+    return checks
+
+
+def test_login_accepted(simulator):
+    server = simulator()
+    check, = telnet_checks(server.server_address[1], 1)
+    assert check['auth_type'] == "Telnet"
+    assert check['error'] == ""
+
+
+def test_login_rejected(simulator):
+    server = simulator(password=b"other")
+    check, = telnet_checks(server.server_address[1], 1)
+    assert check['auth_type'] == "Credentials incorrect but Telnet open"
+    assert check['error'] == "auth_rejected"
+
+
+def test_no_login_prompt(simulator):
+    # A port that never asks for credentials isn't a rejection
+    server = simulator(behaviour='silent')
+    check, = telnet_checks(server.server_address[1], 1)
+    assert check['auth_type'] == ""
+    assert check['error'] == "protocol_error"
+
+
+def test_many_sessions_from_one_thread(simulator):
+    # Every login waits a second for its prompt; run one after another they
+    # would take minutes, multiplexed on the Telnet loop about a second.
+    # Each session uses a socket at both ends
+    limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0] if resource is not None else 2200
+    count = max(100, min(1000, (limit - 200) // 2))
+    server = simulator(delay=1)
+    started = time.time()
+    checks = telnet_checks(server.server_address[1], count)
+    elapsed = time.time() - started
+    assert [check['auth_type'] for check in checks] == ["Telnet"] * count
+    assert elapsed < 10, "%d sessions took %.1fs" % (count, elapsed)